@@ -0,0 +1,202 @@
+# --------------------------------------------------------
+# Benchmarks for the DWS post-processing and the ground truth stamping
+#
+# Pages are synthetic: symbol-sized boxes are scattered over a blank page and
+# the energy, class and bbox maps a perfect network would predict are drawn
+# for them, so no dataset and no GPU are needed.
+#
+# usage: python benchmarks/benchmark_dws.py --sizes 300x420,600x840 --save_baseline baseline.json
+#        python benchmarks/benchmark_dws.py --sizes 300x420,600x840 --baseline baseline.json
+# --------------------------------------------------------
+from __future__ import print_function
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import json
+import resource
+import time
+from multiprocessing import Process, Pipe
+import numpy as np
+from main.dws_transform import perform_dws, find_connected_comp
+from datasets.fcn_groundtruth import get_markers, get_energy_marker, stamp_energy, stamp_class, stamp_bbox
+
+# ground truth settings of train_deepscores.py
+DEEPSCORES_ASSIGNS = [
+    {'ds_factors': [1], 'downsample_marker': True, 'overlap_solution': 'max',
+     'stamp_func': ['stamp_energy', stamp_energy], 'layer_loss_aggregate': 'avg', 'mask_zeros': False,
+     'stamp_args': {'marker_dim': (9, 9), 'size_percentage': 0.8, "shape": "oval", "loss": "softmax",
+                    "energy_shape": "linear"}},
+    {'ds_factors': [1], 'downsample_marker': True, 'overlap_solution': 'no',
+     'stamp_func': ['stamp_class', stamp_class], 'layer_loss_aggregate': 'avg', 'mask_zeros': True,
+     'stamp_args': {'marker_dim': (9, 9), 'size_percentage': 1, "shape": "oval", "class_resolution": "class",
+                    "loss": "softmax"}},
+    {'ds_factors': [1], 'downsample_marker': True, 'overlap_solution': 'nearest',
+     'stamp_func': ['stamp_bbox', stamp_bbox], 'layer_loss_aggregate': 'avg', 'mask_zeros': True,
+     'stamp_args': {'marker_dim': (9, 9), 'size_percentage': 1, "shape": "oval", "loss": "reg"}}]
+
+
+def synthetic_page(height, width, density, nr_classes, seed=0):
+    """
+    Build a score-like page with density symbols per 100x100 pixels.
+    Returns the gt boxes (x1, y1, x2, y2, class) and the energy, class and bbox maps of a perfect prediction.
+    """
+    rng = np.random.RandomState(seed)
+    nr_symbols = int(density * height * width / 10000.0)
+    # symbol sizes between small dots and clefs
+    sizes = rng.randint(6, 40, size=(nr_symbols, 2))
+    y1 = (rng.rand(nr_symbols) * (height - sizes[:, 0])).astype(np.int32)
+    x1 = (rng.rand(nr_symbols) * (width - sizes[:, 1])).astype(np.int32)
+    gt_boxes = np.stack([x1, y1, x1 + sizes[:, 1], y1 + sizes[:, 0], rng.randint(1, nr_classes, nr_symbols)],
+                        1).astype(np.float32)
+
+    energy = np.zeros((height, width), dtype=np.int32)
+    class_map = np.zeros((height, width), dtype=np.int32)
+    bbox_map = np.zeros((height, width, 2), dtype=np.float32)
+    for x1, y1, x2, y2, cls in gt_boxes.astype(np.int32):
+        marker = np.round(get_energy_marker((int((y2 - y1) * 0.8), int((x2 - x1) * 0.8)), "square")).astype(np.int32)
+        top, left = y1 + (y2 - y1 - marker.shape[0]) // 2, x1 + (x2 - x1 - marker.shape[1]) // 2
+        window = (slice(top, top + marker.shape[0]), slice(left, left + marker.shape[1]))
+        energy[window] = np.maximum(energy[window], marker)
+        class_map[window][marker > 0] = cls
+        bbox_map[window][marker > 0] = [y2 - y1, x2 - x1]
+
+    return {'gt_boxes': gt_boxes, 'energy': energy, 'class_map': class_map, 'bbox_map': bbox_map,
+            'nr_classes': nr_classes}
+
+
+def bench_perform_dws(backend):
+    def run(page):
+        perform_dws(page['energy'], page['class_map'], page['bbox_map'], 3, 4, cc_backend=backend)
+        return page['energy'].size
+    return run
+
+
+def bench_find_connected_comp(page):
+    find_connected_comp(np.transpose(np.where(page['energy'] > 3, 0, 255)))
+    return page['energy'].size
+
+
+def bench_get_markers(assign):
+    def run(page):
+        shape = (1,) + page['energy'].shape + (1,)
+        get_markers(shape, page['gt_boxes'], page['nr_classes'], assign, 0, [])
+        return page['energy'].size
+    return run
+
+
+def bench_stamp(assign):
+    def run(page):
+        for bbox in page['gt_boxes']:
+            assign['stamp_func'][1](bbox, assign['stamp_args'], page['nr_classes'])
+        return len(page['gt_boxes'])
+    return run
+
+
+# name -> (function, unit of the work count it returns, only run on small pages)
+BENCHMARKS = [
+    ('perform_dws[scipy]', bench_perform_dws("scipy"), 'pixels', False),
+    ('perform_dws[opencv]', bench_perform_dws("opencv"), 'pixels', False),
+    ('perform_dws[python]', bench_perform_dws("python"), 'pixels', True),
+    ('find_connected_comp', bench_find_connected_comp, 'pixels', True),
+    ('get_markers[stamp_energy]', bench_get_markers(DEEPSCORES_ASSIGNS[0]), 'pixels', False),
+    ('get_markers[stamp_class]', bench_get_markers(DEEPSCORES_ASSIGNS[1]), 'pixels', False),
+    ('get_markers[stamp_bbox]', bench_get_markers(DEEPSCORES_ASSIGNS[2]), 'pixels', False),
+    ('stamp_energy', bench_stamp(DEEPSCORES_ASSIGNS[0]), 'boxes', False),
+    ('stamp_class', bench_stamp(DEEPSCORES_ASSIGNS[1]), 'boxes', False),
+    ('stamp_bbox', bench_stamp(DEEPSCORES_ASSIGNS[2]), 'boxes', False)]
+
+
+def measure(func, page, repeats):
+    """
+    Time func on page in a forked process, so that its peak memory can be read from the process' max rss.
+    """
+    def child(conn):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+        for _ in range(repeats):
+            start = time.time()
+            work = func(page)
+            times.append(time.time() - start)
+        # ru_maxrss is in kilobytes on linux
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0
+        conn.send((times, work, peak_mb))
+        conn.close()
+
+    parent_conn, child_conn = Pipe(duplex=False)
+    p = Process(target=child, args=(child_conn,))
+    p.start()
+    child_conn.close()
+    # raises EOFError if the benchmark process fails
+    times, work, peak_mb = parent_conn.recv()
+    p.join()
+    return {'median': float(np.median(times)), 'min': float(np.min(times)),
+            'throughput': work / float(np.median(times)), 'peak_mem_mb': peak_mb}
+
+
+def run_benchmarks(parsed):
+    results = {}
+    for size in parsed.sizes.split(","):
+        height, width = [int(x) for x in size.split("x")]
+        page = synthetic_page(height, width, parsed.density, parsed.nr_classes, parsed.seed)
+        for name, func, unit, small_only in BENCHMARKS:
+            if parsed.filter not in name:
+                continue
+            if small_only and height * width > parsed.max_reference_pixels:
+                continue
+            result = measure(func, page, parsed.repeats)
+            result['unit'] = unit
+            results[name + '@' + size] = result
+            print('{:<32s} {:>10s}  median {:9.4f}s  {:12.0f} {:s}/s  peak {:8.1f} MB'.format(
+                name, size, result['median'], result['throughput'], unit, result['peak_mem_mb']))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Print the change of every benchmark w.r.t. the baseline, returns the names of the regressed benchmarks.
+    """
+    regressions = []
+    print('')
+    print('Comparison with baseline (tolerance {:.0f}%)'.format(tolerance * 100))
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            print('{:<44s} not in baseline'.format(name))
+            continue
+        ratio = results[name]['median'] / baseline[name]['median']
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print('{:<44s} {:7.2f}x time  {:+8.1f} MB peak {:s}'.format(
+            name, ratio, results[name]['peak_mem_mb'] - baseline[name]['peak_mem_mb'],
+            'REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="300x420,600x840", help="page sizes as HEIGHTxWIDTH, comma separated")
+    parser.add_argument("--density", type=float, default=3.0, help="symbols per 100x100 pixels")
+    parser.add_argument("--nr_classes", type=int, default=124, help="number of classes of the synthetic symbols")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per benchmark, the median is reported")
+    parser.add_argument("--seed", type=int, default=314, help="seed for the synthetic pages")
+    parser.add_argument("--filter", type=str, default="", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--max_reference_pixels", type=int, default=600*840, help="largest page the pure python reference implementations run on")
+    parser.add_argument("--baseline", type=str, default="", help="json file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as regression")
+    parser.add_argument("--save_baseline", type=str, default="", help="write the results as json to this file")
+
+    parsed = parser.parse_known_args()[0]
+
+    results = run_benchmarks(parsed)
+
+    if parsed.save_baseline != "":
+        with open(parsed.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if parsed.baseline != "":
+        with open(parsed.baseline) as f:
+            baseline = json.load(f)
+        if len(compare_to_baseline(results, baseline, parsed.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,100 @@
+# --------------------------------------------------------
+# Load test for a running detection server (main/detection_server.py)
+#
+# Sends pages from several client threads at the same time and reports the
+# request latencies seen by the clients and the counters of the server.
+#
+# usage: python main/detection_server.py --unix_socket /tmp/dws.sock
+#        python benchmarks/load_test_server.py --unix_socket /tmp/dws.sock --images page1.png,page2.png
+# --------------------------------------------------------
+from __future__ import print_function
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import argparse
+import io
+import json
+import threading
+import time
+import numpy as np
+from PIL import Image
+from main.detection_client import get_connection, request_detection
+
+
+def encode_page(img):
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def load_pages(parsed):
+    if parsed.images != "":
+        pages = []
+        for image_path in parsed.images.split(","):
+            with open(image_path, 'rb') as f:
+                pages.append(f.read())
+        return pages
+    # white pages with some dark noise, sizes vary around the given one like real scans
+    rng = np.random.RandomState(parsed.seed)
+    height, width = [int(x) for x in parsed.size.split("x")]
+    pages = []
+    for _ in range(8):
+        shape = (height + rng.randint(-40, 40), width + rng.randint(-40, 40))
+        pages.append(encode_page(np.where(rng.rand(*shape) < 0.01, 0, 255).astype(np.uint8)))
+    return pages
+
+
+def run_client(parsed, pages, nr_requests, latencies, errors):
+    connection = get_connection(parsed.host, parsed.port, parsed.unix_socket)
+    for k in range(nr_requests):
+        start = time.time()
+        try:
+            request_detection(connection, pages[k % len(pages)])
+        except Exception as e:
+            errors.append(str(e))
+            connection.close()
+            connection = get_connection(parsed.host, parsed.port, parsed.unix_socket)
+            continue
+        latencies.append(time.time() - start)
+    connection.close()
+
+
+def get_server_stats(parsed):
+    connection = get_connection(parsed.host, parsed.port, parsed.unix_socket)
+    connection.request("GET", "/stats")
+    stats = json.loads(connection.getresponse().read().decode("utf-8"))
+    connection.close()
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address of the detection server")
+    parser.add_argument("--port", type=int, default=8500, help="port of the detection server")
+    parser.add_argument("--unix_socket", type=str, default="", help="connect to this unix socket instead of host:port")
+    parser.add_argument("--images", type=str, default="", help="comma separated page images to send, synthetic pages if empty")
+    parser.add_argument("--size", type=str, default="1400x1000", help="size of the synthetic pages as HEIGHTxWIDTH")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent client threads")
+    parser.add_argument("--requests", type=int, default=20, help="requests sent by every client")
+    parser.add_argument("--seed", type=int, default=314, help="seed for the synthetic pages")
+
+    parsed = parser.parse_known_args()[0]
+
+    pages = load_pages(parsed)
+    latencies, errors = [], []
+    clients = [threading.Thread(target=run_client, args=(parsed, pages, parsed.requests, latencies, errors))
+               for _ in range(parsed.clients)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.time() - start
+
+    print('{:d} requests in {:.2f}s: {:.2f} pages/s, {:d} errors'.format(
+        len(latencies), duration, len(latencies) / duration, len(errors)))
+    if len(latencies) > 0:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print('client latency  p50 {:8.4f}s  p95 {:8.4f}s  p99 {:8.4f}s'.format(p50, p95, p99))
+    print(json.dumps(get_server_stats(parsed), indent=2, sort_keys=True))
@@ -0,0 +1,66 @@
+"""Per file cache of parsed annotation files."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+from multiprocessing import Pool, cpu_count
+
+
+class AnnotationStore(object):
+  """Caches the result of parse_func for every annotation file, keyed by the
+  file's path and modification time.
+
+  get() only parses files that are not in the cache or changed since they were
+  parsed, in a pool of nr_workers processes. parse_func has to be a module
+  level function so that it can be sent to the workers. The cache holds every
+  file parsed so far, so a growing or different image set reuses the entries
+  of the files it shares with earlier runs.
+  """
+
+  def __init__(self, cache_file, parse_func, nr_workers=None):
+    self.cache_file = cache_file
+    self.parse_func = parse_func
+    self.nr_workers = cpu_count() if nr_workers is None else nr_workers
+
+  def _load(self):
+    if not os.path.exists(self.cache_file):
+      return {}
+    with open(self.cache_file, 'rb') as f:
+      try:
+        return pickle.load(f)
+      except:
+        return pickle.load(f, encoding='bytes')
+
+  def _save(self, entries):
+    # write to a temporary file first, an interrupted run keeps the old cache
+    with open(self.cache_file + '.tmp', 'wb') as f:
+      pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(self.cache_file + '.tmp', self.cache_file)
+
+  def _parse(self, paths):
+    if self.nr_workers <= 1 or len(paths) < 2 * self.nr_workers:
+      return [self.parse_func(path) for path in paths]
+    pool = Pool(self.nr_workers)
+    try:
+      return pool.map(self.parse_func, paths,
+                      chunksize=max(len(paths) // (4 * self.nr_workers), 1))
+    finally:
+      pool.close()
+      pool.join()
+
+  def get(self, paths):
+    """Return the parsed annotation of every path, in the order of paths."""
+    entries = self._load()
+    mtimes = [os.path.getmtime(path) for path in paths]
+    todo = [path for path, mtime in zip(paths, mtimes)
+            if path not in entries or entries[path][0] != mtime]
+    if len(todo) > 0:
+      print('Parsing {:d} of {:d} annotation files'.format(len(todo), len(paths)))
+      path_mtimes = dict(zip(paths, mtimes))
+      for path, parsed in zip(todo, self._parse(todo)):
+        entries[path] = (path_mtimes[path], parsed)
+      print('Saving cached annotations to {:s}'.format(self.cache_file))
+      self._save(entries)
+    return [entries[path][1] for path in paths]
@@ -20,7 +20,8 @@ import utils.bbox
 import pickle
 import subprocess
 import uuid
-from datasets.voc_eval import voc_eval
+from datasets.voc_eval import voc_eval_all, write_detections_file
+from datasets.annotation_store import AnnotationStore
 from main.config import cfg
 import random
 
@@ -50,6 +51,7 @@ class deep_scores(imdb):
                    'use_salt': True,
                    'use_diff': False,
                    'matlab_eval': False,
+                   'text_results': False,
                    'rpn_file': None}
 
     assert os.path.exists(self._devkit_path), \
@@ -111,26 +113,46 @@ class deep_scores(imdb):
     """
     Return the database of ground-truth regions of interest.
 
-    This function loads/saves from/to a cache file to speed up future calls.
+    The parsed annotation files are cached per file, shared by all image sets
+    of the dataset. Only new or changed files are parsed, in parallel.
     """
-    cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-    if os.path.exists(cache_file):
-      with open(cache_file, 'rb') as fid:
-        try:
-          roidb = pickle.load(fid)
-        except:
-          roidb = pickle.load(fid, encoding='bytes')
-      print('{} gt roidb loaded from {}'.format(self.name, cache_file))
-      return roidb
-
-    gt_roidb = [self._load_musical_annotation(index)
-                for index in self.image_index]
-    with open(cache_file, 'wb') as fid:
-      pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-    print('wrote gt roidb to {}'.format(cache_file))
-
+    gt_roidb = [self._load_musical_annotation(index, annotation)
+                for index, annotation in zip(self.image_index,
+                                             self._load_annotations())]
     return gt_roidb
 
+  def gt_columns(self):
+    """
+    The boxes of gt_roidb as columns for a ColumnarRoidb: boxes, classes and
+    areas of all images concatenated, box_offsets[i] to box_offsets[i + 1]
+    are the boxes of image i. Computed from the parsed annotations in one pass
+    over all boxes, no per image dicts are built.
+    """
+    annotations = self._load_annotations()
+    nr_boxes = np.array([len(a['names']) for a in annotations], dtype=np.int64)
+    widths = np.repeat([a['width'] for a in annotations], nr_boxes)
+    heights = np.repeat([a['height'] for a in annotations], nr_boxes)
+    bbox = np.concatenate([np.zeros((0, 4))] + [a['bbox'] for a in annotations])
+    boxes, seg_areas = scale_musical_boxes(bbox, widths, heights)
+    gt_classes = np.array([self._class_to_ind[name]
+                           for a in annotations for name in a['names']],
+                          dtype=np.int32)
+    # gt boxes overlap only with their own class
+    return {'flipped': np.zeros(len(annotations), dtype=bool),
+            'box_offsets': np.concatenate([[0], np.cumsum(nr_boxes)]),
+            'boxes': boxes,
+            'gt_classes': gt_classes,
+            'max_classes': gt_classes.astype(np.int64),
+            'max_overlaps': np.ones(len(gt_classes), dtype=np.float32),
+            'seg_areas': seg_areas}
+
+  def _load_annotations(self):
+    store = AnnotationStore(
+      os.path.join(self.cache_path, 'DeepScores_' + self._year + '_annots.pkl'),
+      parse_musical_annotation)
+    return store.get([self._get_annotation_path(index)
+                      for index in self.image_index])
+
   def rpn_roidb(self):
     if int(self._year) == 2017 or self._image_set != 'test':
       gt_roidb = self.gt_roidb()
@@ -150,38 +172,26 @@ class deep_scores(imdb):
       box_list = pickle.load(f)
     return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-  def _load_musical_annotation(self, index):
+  def _get_annotation_path(self, index):
+    return os.path.join(self._data_path, 'xml_annotations', index + '.xml')
+
+  def _load_musical_annotation(self, index, annotation=None):
     """
     Load image and bounding boxes info from XML file in the PASCAL VOC
-    format.
+    format, or from its already parsed annotation.
     """
-    filename = os.path.join(self._data_path, 'xml_annotations', index + '.xml')
-    tree = ET.parse(filename)
-    objs = tree.findall('object')
-    num_objs = len(objs)
+    if annotation is None:
+      annotation = parse_musical_annotation(self._get_annotation_path(index))
+    num_objs = len(annotation['names'])
 
-    boxes = np.zeros((num_objs, 4), dtype=np.uint16)
     gt_classes = np.zeros((num_objs), dtype=np.int32)
     overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
-    # "Seg" area for pascal is just the box area
-    seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-    size = tree.find("size")
-    height = float(size.find("height").text)
-    width = float(size.find("width").text)
-    # Load object bounding boxes into a data frame.
-    for ix, obj in enumerate(objs):
-      bbox = obj.find('bndbox')
-      # Pixel indexes should already be 0 bases
-      x1 = np.floor(float(bbox.find('xmin').text)*width)
-      y1 = np.floor(float(bbox.find('ymin').text)*height)
-      x2 = np.floor(float(bbox.find('xmax').text)*width)
-      y2 = np.floor(float(bbox.find('ymax').text)*height)
-      cls = self._class_to_ind[obj.find('name').text]#.lower().strip()]
-      boxes[ix, :] = [x1, y1, x2, y2]
-      gt_classes[ix] = cls
-      overlaps[ix, cls] = 1.0
-      seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    boxes, seg_areas = scale_musical_boxes(annotation['bbox'],
+                                           annotation['width'],
+                                           annotation['height'])
+    gt_classes[:] = [self._class_to_ind[name] for name in annotation['names']]
+    overlaps[np.arange(num_objs), gt_classes] = 1.0
 
     overlaps = scipy.sparse.csr_matrix(overlaps)
 
@@ -206,6 +216,17 @@ class deep_scores(imdb):
       filename)
     return path
 
+  def _get_results_file(self):
+    # all classes in one binary file next to the text results
+    filename = self._get_comp_id() + '_det_' + self._image_set + '.npz'
+    return os.path.join(
+      os.path.dirname(self._get_voc_results_file_template()), filename)
+
+  def _write_results_file(self, all_boxes):
+    print('Writing results file')
+    write_detections_file(self._get_results_file(), all_boxes,
+                          self.image_index, self.classes)
+
   def _write_voc_results_file(self, all_boxes):
    for cls_ind, cls in enumerate(self.classes):
       if cls == '__background__':
@@ -215,12 +236,12 @@ class deep_scores(imdb):
       with open(filename, 'wt') as f:
         for im_ind, index in enumerate(self.image_index):
           dets = all_boxes[cls_ind][im_ind]
-          if dets == []:
+          if len(dets) == 0:
             continue
-          # the VOCdevkit expects 1-based indices
+          # the VOCdevkit expects 1-based indices, column 5 is the detection score
           for k in range(dets.shape[0]):
             f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                    format(index, dets[k, -1],
+                    format(index, dets[k, 5],
                            dets[k, 0] + 1, dets[k, 1] + 1,
                            dets[k, 2] + 1, dets[k, 3] + 1))
 
@@ -241,13 +262,15 @@ class deep_scores(imdb):
     print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
     if not os.path.isdir(output_dir):
       os.mkdir(output_dir)
-    for i, cls in enumerate(self._classes):
-      if cls == '__background__':
-        continue
-      filename = self._get_voc_results_file_template().format(cls)
-      rec, prec, ap = voc_eval(
-        filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-        use_07_metric=use_07_metric)
+    # ground truth and detections are read once for all classes
+    classes = [cls for cls in self._classes if cls != '__background__']
+    # boxes are scaled with the persisted image size index
+    image_sizes = dict(zip(self.image_index, self.image_sizes()))
+    results = voc_eval_all(
+      self._get_results_file(), annopath, imagesetfile, classes, cachedir,
+      ovthresh=0.5, use_07_metric=use_07_metric, image_sizes=image_sizes)
+    for cls in classes:
+      rec, prec, ap = results[cls]
       aps += [ap]
       print(('AP for {} = {:.4f}'.format(cls, ap)))
       with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
@@ -283,16 +306,22 @@ class deep_scores(imdb):
     status = subprocess.call(cmd, shell=True)
 
   def evaluate_detections(self, all_boxes, output_dir):
-    self._write_voc_results_file(all_boxes)
+    self._write_results_file(all_boxes)
+    # the text files are only needed by the matlab code or on request
+    write_text = self.config['text_results'] or self.config['matlab_eval']
+    if write_text:
+      self._write_voc_results_file(all_boxes)
     self._do_python_eval(output_dir)
     if self.config['matlab_eval']:
       self._do_matlab_eval(output_dir)
     if self.config['cleanup']:
-      for cls in self._classes:
-        if cls == '__background__':
-          continue
-        filename = self._get_voc_results_file_template().format(cls)
-        os.remove(filename)
+      os.remove(self._get_results_file())
+      if write_text:
+        for cls in self._classes:
+          if cls == '__background__':
+            continue
+          filename = self._get_voc_results_file_template().format(cls)
+          os.remove(filename)
 
   def competition_mode(self, on):
     if on:
@@ -303,6 +332,38 @@ class deep_scores(imdb):
       self.config['cleanup'] = True
 
 
+def parse_musical_annotation(filename):
+  """
+  Read the image size, the class names and the relative bounding boxes of a
+  DeepScores XML annotation file.
+  """
+  tree = ET.parse(filename)
+  size = tree.find("size")
+  objs = tree.findall('object')
+  bbox = [[float(obj.find('bndbox').find(coord).text)
+           for coord in ('xmin', 'ymin', 'xmax', 'ymax')] for obj in objs]
+  return {'width': float(size.find("width").text),
+          'height': float(size.find("height").text),
+          'names': [obj.find('name').text for obj in objs],
+          'bbox': np.array(bbox, dtype=np.float64).reshape(-1, 4)}
+
+
+def scale_musical_boxes(bbox, widths, heights):
+  """
+  Scale relative (x1, y1, x2, y2) boxes to pixels, widths and heights are
+  scalars or one value per box. Returns the uint16 boxes and their float32
+  "seg" areas, which for pascal are just the box areas.
+  """
+  # Pixel indexes should already be 0 bases
+  x1 = np.floor(bbox[:, 0] * widths)
+  y1 = np.floor(bbox[:, 1] * heights)
+  x2 = np.floor(bbox[:, 2] * widths)
+  y2 = np.floor(bbox[:, 3] * heights)
+  boxes = np.stack([x1, y1, x2, y2], axis=1).astype(np.uint16)
+  seg_areas = ((x2 - x1 + 1) * (y2 - y1 + 1)).astype(np.float32)
+  return boxes, seg_areas
+
+
 if __name__ == '__main__':
 
   d = deep_scores('trainval', '2017')
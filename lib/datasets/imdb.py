@@ -10,8 +10,9 @@ from __future__ import print_function
 
 import os
 import os.path as osp
-import PIL
+import pickle
 from utils.bbox import bbox_overlaps
+from utils.image_size import get_image_size
 import numpy as np
 import scipy.sparse
 from main.config import cfg
@@ -98,13 +99,41 @@ class imdb(object):
     Each of those list elements is either an empty list []
     or a numpy array of detection.
 
-    all_boxes[class][image] = [] or np.array of shape #dets x 5
+    all_boxes[class][image] = [] or np.array of shape #dets x 6
+    with rows (x1, y1, x2, y2, class, score)
     """
     raise NotImplementedError
 
+  def image_sizes(self):
+    """
+    Return (width, height) of every image. The sizes are read from the image
+    headers and kept in an index next to the roidb cache together with the
+    modification time of every image, later calls only read the headers of
+    images not yet in the index or changed since.
+    """
+    cache_file = osp.join(self.cache_path, self.name + '_image_sizes.pkl')
+    sizes = {}
+    if osp.exists(cache_file):
+      with open(cache_file, 'rb') as fid:
+        sizes = pickle.load(fid)
+
+    paths = [self.image_path_at(i) for i in range(self.num_images)]
+    mtimes = dict((path, osp.getmtime(path)) for path in paths)
+    # entries are (mtime, (width, height)), entries of older indices hold
+    # only (width, height) and never match the mtime, they are read again
+    missing = set(path for path in paths
+                  if path not in sizes or sizes[path][0] != mtimes[path])
+    if len(missing) > 0:
+      for path in missing:
+        sizes[path] = (mtimes[path], get_image_size(path))
+      with open(cache_file + '.tmp', 'wb') as fid:
+        pickle.dump(sizes, fid, pickle.HIGHEST_PROTOCOL)
+      os.rename(cache_file + '.tmp', cache_file)
+      print('wrote image sizes to {}'.format(cache_file))
+    return [sizes[path][1] for path in paths]
+
   def _get_widths(self):
-    return [PIL.Image.open(self.image_path_at(i)).size[0]
-            for i in range(self.num_images)]
+    return [size[0] for size in self.image_sizes()]
 
   def append_flipped_images(self):
     num_images = self.num_images
@@ -20,7 +20,7 @@ import utils.bbox
 import pickle
 import subprocess
 import uuid
-from datasets.voc_eval import voc_eval
+from datasets.voc_eval import voc_eval_all, write_detections_file
 from main.config import cfg
 import random
 from datasets.voc_eval import parse_rec
@@ -53,6 +53,7 @@ class musicma(imdb):
                    'use_salt': True,
                    'use_diff': False,
                    'matlab_eval': False,
+                   'text_results': False,
                    'rpn_file': None}
 
     assert os.path.exists(self._devkit_path), \
@@ -204,6 +205,17 @@ class musicma(imdb):
       filename)
     return path
 
+  def _get_results_file(self):
+    # all classes in one binary file next to the text results
+    filename = self._get_comp_id() + '_det_' + self._image_set + '.npz'
+    return os.path.join(
+      os.path.dirname(self._get_voc_results_file_template()), filename)
+
+  def _write_results_file(self, all_boxes):
+    print('Writing results file')
+    write_detections_file(self._get_results_file(), all_boxes,
+                          self.image_index, self.classes)
+
   def _write_voc_results_file(self, all_boxes):
    for cls_ind, cls in enumerate(self.classes):
       if cls == '__background__':
@@ -213,14 +225,14 @@ class musicma(imdb):
       with open(filename, 'wt') as f:
         for im_ind, index in enumerate(self.image_index):
           dets = all_boxes[cls_ind][im_ind]
-          if dets == []:
+          if len(dets) == 0:
             continue
-          # the VOCdevkit expects 1-based indices
-          for k in range(dets[0].shape[0]):
+          # the VOCdevkit expects 1-based indices, column 5 is the detection score
+          for k in range(dets.shape[0]):
             f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                    format(index, dets[0][-1],
-                           dets[0][0] + 1, dets[0][1] + 1,
-                           dets[0][2] + 1, dets[0][3] + 1))
+                    format(index, dets[k, 5],
+                           dets[k, 0] + 1, dets[k, 1] + 1,
+                           dets[k, 2] + 1, dets[k, 3] + 1))
 
   def _do_python_eval(self, output_dir='output'):
     annopath = os.path.join(
@@ -241,13 +253,13 @@ class musicma(imdb):
     print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
     if not os.path.isdir(output_dir):
       os.mkdir(output_dir)
-    for i, cls in enumerate(self._classes):
-      if cls == '__background__':
-        continue
-      filename = self._get_voc_results_file_template().format(cls)
-      rec, prec, ap = voc_eval(
-        filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-        use_07_metric=use_07_metric)
+    # ground truth and detections are read once for all classes
+    classes = [cls for cls in self._classes if cls != '__background__']
+    results = voc_eval_all(
+      self._get_results_file(), annopath, imagesetfile, classes, cachedir,
+      ovthresh=0.5, use_07_metric=use_07_metric)
+    for cls in classes:
+      rec, prec, ap = results[cls]
       aps += [ap]
       print(('AP for {} = {:.4f}'.format(cls, ap)))
       with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
@@ -283,16 +295,22 @@ class musicma(imdb):
     status = subprocess.call(cmd, shell=True)
 
   def evaluate_detections(self, all_boxes, output_dir):
-    self._write_voc_results_file(all_boxes)
+    self._write_results_file(all_boxes)
+    # the text files are only needed by the matlab code or on request
+    write_text = self.config['text_results'] or self.config['matlab_eval']
+    if write_text:
+      self._write_voc_results_file(all_boxes)
     self._do_python_eval(output_dir)
     if self.config['matlab_eval']:
       self._do_matlab_eval(output_dir)
     if self.config['cleanup']:
-      for cls in self._classes:
-        if cls == '__background__':
-          continue
-        filename = self._get_voc_results_file_template().format(cls)
-        os.remove(filename)
+      os.remove(self._get_results_file())
+      if write_text:
+        for cls in self._classes:
+          if cls == '__background__':
+            continue
+          filename = self._get_voc_results_file_template().format(cls)
+          os.remove(filename)
 
   def competition_mode(self, on):
     if on:
@@ -0,0 +1,119 @@
+# --------------------------------------------------------
+# Equivalence tests of the connected component backends of perform_dws
+# against the original dict based labeling and box assembly
+#
+# usage (from lib/): python -m unittest datasets.test_dws_transform
+# --------------------------------------------------------
+import unittest
+import numpy as np
+from main.dws_transform import perform_dws, label_components, find_connected_comp, CC_BACKENDS
+
+
+def reference_dws(dws_energy, class_map, bbox_map, cutoff=0, min_ccoponent_size=0):
+    """
+    perform_dws as it was before the labeling backends: python labeling into a {(x, y): label} dict and one box
+    per component, computed component by component.
+    """
+    binar_energy = (dws_energy <= cutoff) * 255
+    labels, _ = find_connected_comp(np.transpose(binar_energy))
+    labels_inv = {}
+    for k, v in labels.items():
+        labels_inv.setdefault(v, []).append(k)
+
+    bbox_list = []
+    for pixels in labels_inv.values():
+        if len(pixels) < min_ccoponent_size:
+            continue
+        pixel_coords = np.asanyarray(pixels)
+        center = np.average(pixel_coords, 0).astype(int)
+        cls = np.bincount(class_map[pixel_coords[:, 1], pixel_coords[:, 0]]).argmax()
+        bbox_size = np.amax(bbox_map[pixel_coords[:, 1], pixel_coords[:, 0]], 0).astype(int)
+        bbox_list.append([int(np.round(center[0] - (bbox_size[1] / 2.0), 0)),
+                          int(np.round(center[1] - (bbox_size[0] / 2.0), 0)),
+                          int(np.round(center[0] + (bbox_size[1] / 2.0), 0)),
+                          int(np.round(center[1] + (bbox_size[0] / 2.0), 0)),
+                          int(cls)])
+    return sort_boxes(np.array(bbox_list, dtype=np.float32).reshape(-1, 5))
+
+
+def sort_boxes(boxes):
+    # components are numbered differently by every backend, compare boxes in a fixed order
+    return boxes[np.lexsort(boxes.T[::-1])]
+
+
+def canonical_labels(labels):
+    # renumber components in order of their first pixel, so label images of different backends are comparable
+    _, first, inverse = np.unique(labels.ravel(), return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first))
+    return rank[inverse].reshape(labels.shape)
+
+
+def random_maps(rng, shape, density, nr_classes=5):
+    dws_energy = np.where(rng.rand(*shape) < density, rng.randint(1, 10, size=shape), 0)
+    class_map = rng.randint(0, nr_classes, size=shape)
+    bbox_map = rng.randint(1, 40, size=shape + (2,))
+    return dws_energy, class_map, bbox_map
+
+
+class TestConnectedComponents(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(314)
+
+    def check_maps(self, dws_energy, class_map, bbox_map, cutoff=0, min_ccoponent_size=0):
+        expected = reference_dws(dws_energy, class_map, bbox_map, cutoff, min_ccoponent_size)
+        for backend in sorted(CC_BACKENDS):
+            boxes = perform_dws(dws_energy, class_map, bbox_map, cutoff, min_ccoponent_size, cc_backend=backend)
+            self.assertEqual(boxes.shape, (len(expected), 6), backend)
+            np.testing.assert_array_equal(sort_boxes(boxes[:, :5]), expected, err_msg=backend)
+
+    def test_random_maps(self):
+        for shape, density in [((37, 53), 0.2), ((64, 48), 0.45), ((20, 90), 0.7)]:
+            dws_energy, class_map, bbox_map = random_maps(self.rng, shape, density)
+            for cutoff in [0, 3]:
+                self.check_maps(dws_energy, class_map, bbox_map, cutoff)
+
+    def test_min_component_size(self):
+        dws_energy, class_map, bbox_map = random_maps(self.rng, (50, 50), 0.4)
+        for min_ccoponent_size in [1, 2, 4, 10, 10000]:
+            self.check_maps(dws_energy, class_map, bbox_map, 0, min_ccoponent_size)
+
+    def test_empty_map(self):
+        dws_energy, class_map, bbox_map = random_maps(self.rng, (30, 40), 0.0)
+        self.check_maps(dws_energy, class_map, bbox_map)
+        # everything below the cutoff
+        dws_energy, class_map, bbox_map = random_maps(self.rng, (30, 40), 0.5)
+        self.check_maps(dws_energy, class_map, bbox_map, cutoff=10)
+        for backend in sorted(CC_BACKENDS):
+            labels, nr_components = label_components(np.zeros((30, 40), dtype=bool), backend)
+            self.assertEqual(nr_components, 0)
+            self.assertFalse(labels.any())
+
+    def test_single_pixel_components(self):
+        # isolated pixels on a grid with gaps of one pixel, every pixel is its own component
+        dws_energy = np.zeros((21, 31), dtype=np.int64)
+        dws_energy[::2, ::2] = 5
+        _, class_map, bbox_map = random_maps(self.rng, dws_energy.shape, 0.0)
+        self.check_maps(dws_energy, class_map, bbox_map)
+        self.check_maps(dws_energy, class_map, bbox_map, min_ccoponent_size=2)
+        for backend in sorted(CC_BACKENDS):
+            self.assertEqual(label_components(dws_energy > 0, backend)[1], 11 * 16)
+
+    def test_diagonal_connectivity(self):
+        # diagonal neighbours are connected (8-connectivity)
+        foreground = np.eye(12, dtype=bool) | np.eye(12, dtype=bool)[::-1]
+        for backend in sorted(CC_BACKENDS):
+            self.assertEqual(label_components(foreground, backend)[1], 1, backend)
+
+    def test_label_images_match(self):
+        foreground = self.rng.rand(45, 61) < 0.4
+        expected = canonical_labels(label_components(foreground, "python")[0])
+        for backend in sorted(CC_BACKENDS):
+            labels, nr_components = label_components(foreground, backend)
+            self.assertEqual(labels.dtype, np.int32)
+            self.assertEqual(nr_components, labels.max())
+            np.testing.assert_array_equal(canonical_labels(labels), expected, err_msg=backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,9 +9,10 @@ from __future__ import print_function
 
 import xml.etree.ElementTree as ET
 import os
-import pickle
 import numpy as np
-from PIL import Image
+from utils.bbox import bbox_overlaps
+from utils.image_size import get_image_size
+from datasets.annotation_store import AnnotationStore
 
 def parse_rec(filename, muscima, rescale_factor=0.5):
   """ Parse a PASCAL VOC xml file """
@@ -52,14 +53,24 @@ def parse_rec(filename, muscima, rescale_factor=0.5):
   return objects
 
 
-def parse_rec_deepscores(filename):
-  """ Parse a PASCAL VOC xml file """
+def parse_rec_deepscores(filename, im_size=None):
+  """ Parse a DeepScores xml file, the relative boxes are scaled by im_size
+  (width, height), which is read from the image header if not given. """
+  if im_size is None:
+    im_size = get_image_size(deepscores_image_path(filename))
+  return scale_rec_deepscores(read_rec_deepscores(filename), im_size)
+
+
+def deepscores_image_path(filename):
+  return filename.replace("xml_annotations", "images_png")[:-4] + ".png"
+
+
+def read_rec_deepscores(filename):
+  """ Parse a DeepScores xml file, boxes stay relative to the image size """
 
   tree = ET.parse(filename)
   objects = []
 
-  # get image size to scale gt bbox
-  im_size = Image.open(filename.replace("xml_annotations", "images_png")[:-4] + ".png").convert('L').size
   for obj in tree.findall('object'):
     obj_struct = {}
     obj_struct['name'] = obj.find('name').text
@@ -67,20 +78,89 @@ def parse_rec_deepscores(filename):
     obj_struct['truncated'] = int(0)
     obj_struct['difficult'] = int(0)
     bbox = obj.find('bndbox')
-    obj_struct['bbox'] = [(bbox.find('xmin').text),
-                          (bbox.find('ymin').text),
-                          (bbox.find('xmax').text),
-                          (bbox.find('ymax').text)]
+    obj_struct['bbox'] = [float(bbox.find('xmin').text),
+                          float(bbox.find('ymin').text),
+                          float(bbox.find('xmax').text),
+                          float(bbox.find('ymax').text)]
+    objects.append(obj_struct)
 
-    obj_struct['bbox'][0] = int(round(float(obj_struct['bbox'][0]) * im_size[0]))
-    obj_struct['bbox'][1] = int(round(float(obj_struct['bbox'][1]) * im_size[1]))
-    obj_struct['bbox'][2] = int(round(float(obj_struct['bbox'][2]) * im_size[0]))
-    obj_struct['bbox'][3] = int(round(float(obj_struct['bbox'][3]) * im_size[1]))
+  return objects
 
-    objects.append(obj_struct)
 
+def scale_rec_deepscores(objects, im_size):
+  """ Scale the relative boxes of read_rec_deepscores to pixels """
+  scaled = []
+  for obj in objects:
+    obj = dict(obj)
+    obj['bbox'] = [int(round(obj['bbox'][0] * im_size[0])),
+                   int(round(obj['bbox'][1] * im_size[1])),
+                   int(round(obj['bbox'][2] * im_size[0])),
+                   int(round(obj['bbox'][3] * im_size[1]))]
+    scaled.append(obj)
+  return scaled
+
+
+def write_detections_file(detfile, all_boxes, image_index, classes):
+  """ Write all_boxes[class][image] (N x 6 arrays of x1, y1, x2, y2, class,
+  score) to a single .npz file, the binary counterpart of the per class
+  results text files. Detections are sorted by class, the ones of class k are
+  rows class_offsets[k]:class_offsets[k + 1]. Boxes are 1-based like in the
+  text files.
+  """
+  images, boxes, scores = [], [], []
+  class_counts = np.zeros(len(classes), dtype=np.int64)
+  for cls_ind in range(len(classes)):
+    for im_ind, dets in enumerate(all_boxes[cls_ind]):
+      if len(dets) == 0:
+        continue
+      dets = np.asarray(dets)
+      images.append(np.full(len(dets), im_ind, dtype=np.int32))
+      boxes.append(dets[:, :4].astype(np.float32) + 1)
+      scores.append(dets[:, 5].astype(np.float32))
+      class_counts[cls_ind] += len(dets)
+  if len(images) == 0:
+    images, boxes, scores = [np.zeros(0, np.int32)], [np.zeros((0, 4), np.float32)], [np.zeros(0, np.float32)]
+
+  with open(detfile, 'wb') as f:
+    np.savez(f, classes=np.array(classes), image_index=np.array(image_index),
+             class_offsets=np.concatenate([[0], np.cumsum(class_counts)]),
+             images=np.concatenate(images), boxes=np.concatenate(boxes),
+             scores=np.concatenate(scores))
+
+
+def load_detections_file(detfile):
+  """ Read a file written by write_detections_file into a dict of arrays. """
+  with np.load(detfile) as dets:
+    return dict(dets.items())
+
+
+def load_class_detections(detfile, classname, dets=None):
+  """ Read the detections of one class from a file written by
+  write_detections_file (or from its already loaded dets), returns image ids,
+  confidences and boxes like the parsed results text file.
+  """
+  if dets is None:
+    dets = load_detections_file(detfile)
+  cls_ind = dets['classes'].tolist().index(classname)
+  start, end = dets['class_offsets'][cls_ind:cls_ind + 2]
+  image_index = dets['image_index'].tolist()
+  image_ids = [image_index[i] for i in dets['images'][start:end]]
+  return image_ids, dets['scores'][start:end].astype(float), \
+    dets['boxes'][start:end].astype(float)
+
+
+def load_text_detections(detfile):
+  """ Read a per class results text file, returns image ids, confidences and
+  boxes.
+  """
+  with open(detfile, 'r') as f:
+    lines = f.readlines()
 
-  return objects
+  splitlines = [x.strip().split(' ') for x in lines]
+  image_ids = [x[0] for x in splitlines]
+  confidence = np.array([float(x[1]) for x in splitlines])
+  BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+  return image_ids, confidence, BB
 
 
 def voc_ap(rec, prec, use_07_metric=False):
@@ -117,42 +197,19 @@ def voc_ap(rec, prec, use_07_metric=False):
   return ap
 
 
-def voc_eval(detpath,
-             annopath,
-             imagesetfile,
-             classname,
-             cachedir,
-             ovthresh=0.5,
-             use_07_metric=False):
-  """rec, prec, ap = voc_eval(detpath,
-                              annopath,
-                              imagesetfile,
-                              classname,
-                              [ovthresh],
-                              [use_07_metric])
-
-  Top level function that does the PASCAL VOC evaluation.
+def load_annotations(annopath, imagesetfile, cachedir, deepscores,
+                     image_sizes=None):
+  """ Read the image set and the annotations of all its images present on
+  disk, returns the image names and the records per image. The records are
+  cached per annotation file in cachedir, only new or changed files are
+  parsed.
 
-  detpath: Path to detections
-      detpath.format(classname) should produce the detection results file.
-  annopath: Path to annotations
-      annopath.format(imagename) should be the xml annotations file.
-  imagesetfile: Text file containing the list of images, one image per line.
-  classname: Category name (duh)
-  cachedir: Directory for caching the annotations
-  [ovthresh]: Overlap threshold (default = 0.5)
-  [use_07_metric]: Whether to use VOC07's 11 point AP computation
-      (default False)
+  DeepScores boxes are cached relative to the image size and scaled with
+  image_sizes[imagename] = (width, height), e.g. from imdb.image_sizes().
+  Images missing from image_sizes have their size read from the header.
   """
-  # assumes detections are in detpath.format(classname)
-  # assumes annotations are in annopath.format(imagename)
-  # assumes imagesetfile is a text file with each line an image name
-  # cachedir caches the annotations in a pickle file
-
-  # first load gt
   if not os.path.isdir(cachedir):
     os.mkdir(cachedir)
-  cachefile = os.path.join(cachedir, '%s_annots.pkl' % imagesetfile)
   # read list of images
   with open(imagesetfile, 'r') as f:
     lines = f.readlines()
@@ -166,99 +223,102 @@ def voc_eval(detpath,
   imagenames = list(imagenames.intersection(present_files))
 
   print("start reading annotations")
-  if not os.path.isfile(cachefile):
-    # load annotations
-    recs = {}
-    for i, imagename in enumerate(imagenames):
-      if "DeepScores" in detpath:
-        recs[imagename] = parse_rec_deepscores(annopath.format(imagename))
-      else:
-        recs[imagename] = parse_rec(annopath.format(imagename))
-      if i % 100 == 0:
-        print('Reading annotation for {:d}/{:d}'.format(
-          i + 1, len(imagenames)))
-    # save
-    print('Saving cached annotations to {:s}'.format(cachefile))
-    with open(cachefile, 'w') as f:
-      pickle.dump(recs, f)
-  else:
-    # load
-    with open(cachefile, 'rb') as f:
-      try:
-        recs = pickle.load(f)
-      except:
-        recs = pickle.load(f, encoding='bytes')
-
-  # extract gt objects for this class
-  class_recs = {}
-  npos = 0
+  parse_func = read_rec_deepscores if deepscores else parse_rec
+  store = AnnotationStore(
+    os.path.join(cachedir, parse_func.__name__ + '_annots.pkl'), parse_func)
+  annopaths = [annopath.format(x) for x in imagenames]
+  recs = dict(zip(imagenames, store.get(annopaths)))
+  if deepscores:
+    if image_sizes is None:
+      image_sizes = {}
+    for imagename, filename in zip(imagenames, annopaths):
+      im_size = image_sizes.get(imagename)
+      if im_size is None:
+        im_size = get_image_size(deepscores_image_path(filename))
+      recs[imagename] = scale_rec_deepscores(recs[imagename], im_size)
+  return imagenames, recs
+
+
+def group_by_class(imagenames, recs, classnames):
+  """ Split the records of all images by class in one pass over the objects.
+  Returns class_recs[classname][imagename] = {'bbox': N x 4 array,
+  'difficult': N bool array} for the images that hold objects of the class,
+  and npos[classname], the number of not difficult objects per class.
+  Which objects are already detected is tracked by eval_class.
+  """
+  class_objs = dict((classname, {}) for classname in classnames)
   for imagename in imagenames:
-    R = [obj for obj in recs[imagename] if obj['name'] == classname]
-    bbox = np.array([x['bbox'] for x in R])
-    difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-    det = [False] * len(R)
-    npos = npos + sum(~difficult)
-    class_recs[imagename] = {'bbox': bbox,
-                             'difficult': difficult,
-                             'det': det}
-
-  # read dets
-  detfile = detpath.format(classname)
-  with open(detfile, 'r') as f:
-    lines = f.readlines()
-
-  splitlines = [x.strip().split(' ') for x in lines]
-  image_ids = [x[0] for x in splitlines]
-  confidence = np.array([float(x[1]) for x in splitlines])
-  BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+    for obj in recs[imagename]:
+      if obj['name'] in class_objs:
+        class_objs[obj['name']].setdefault(imagename, []).append(obj)
 
+  class_recs = {}
+  npos = {}
+  for classname, image_objs in class_objs.items():
+    class_recs[classname] = {}
+    npos[classname] = 0
+    for imagename, R in image_objs.items():
+      bbox = np.array([x['bbox'] for x in R])
+      difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+      npos[classname] += sum(~difficult)
+      class_recs[classname][imagename] = {'bbox': bbox,
+                                          'difficult': difficult}
+  return class_recs, npos
+
+
+def eval_class(class_recs, npos, image_ids, confidence, BB, ovthresh=0.5,
+               use_07_metric=False):
+  """ rec, prec, ap of the detections of one class given its ground truth
+  records per image. Images without records have no objects of the class.
+
+  Going down the detections by confidence, a detection is a TP if its best
+  overlapping ground truth box overlaps more than ovthresh, is not difficult
+  and was not claimed by an earlier detection. Detections whose best box is
+  difficult are neither TP nor FP. As the best box does not depend on earlier
+  detections, the overlaps of all detections of an image are computed at once
+  and the first claim of every ground truth box is found by np.unique.
+  """
   nd = len(image_ids)
   tp = np.zeros(nd)
   fp = np.zeros(nd)
 
   if BB.shape[0] > 0:
     # sort by confidence
-    sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
-    BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    for d in range(nd):
-      R = class_recs[image_ids[d]]
-      bb = BB[d, :].astype(float)
-      ovmax = -np.inf
-      BBGT = R['bbox'].astype(float)
-
-      if BBGT.size > 0:
-        # compute overlaps
-        # intersection
-        ixmin = np.maximum(BBGT[:, 0], bb[0])
-        iymin = np.maximum(BBGT[:, 1], bb[1])
-        ixmax = np.minimum(BBGT[:, 2], bb[2])
-        iymax = np.minimum(BBGT[:, 3], bb[3])
-        iw = np.maximum(ixmax - ixmin + 1., 0.)
-        ih = np.maximum(iymax - iymin + 1., 0.)
-        inters = iw * ih
-
-        # union
-        uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-               (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-               (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-        overlaps = inters / uni
-        ovmax = np.max(overlaps)
-        jmax = np.argmax(overlaps)
-
-      if ovmax > ovthresh:
-        if not R['difficult'][jmax]:
-          if not R['det'][jmax]:
-            tp[d] = 1.
-            R['det'][jmax] = 1
-          else:
-            fp[d] = 1.
-      else:
-        fp[d] = 1.
+    sorted_ind = np.argsort(-confidence, kind="mergesort")
+    BB = np.ascontiguousarray(BB[sorted_ind, :], dtype=np.float64)
+    image_ids = np.array(image_ids)[sorted_ind]
+
+    ovmax = np.full(nd, -np.inf)
+    difficult = np.zeros(nd, dtype=bool)
+    # ground truth box claimed by each detection, unique over all images
+    gt_ind = np.zeros(nd, dtype=np.int64)
+    nr_gt = 0
+
+    # group the detections by image, keeping the confidence order
+    images, det_images = np.unique(image_ids, return_inverse=True)
+    order = np.argsort(det_images, kind="mergesort")
+    starts = np.searchsorted(det_images[order], np.arange(len(images) + 1))
+    for k, imagename in enumerate(images):
+      R = class_recs.get(imagename)
+      if R is None or R['bbox'].size == 0:
+        continue
+      inds = order[starts[k]:starts[k + 1]]
+      BBGT = np.ascontiguousarray(R['bbox'], dtype=np.float64)
+      overlaps = bbox_overlaps(BB[inds], BBGT)
+      jmax = overlaps.argmax(axis=1)
+      ovmax[inds] = overlaps.max(axis=1)
+      difficult[inds] = R['difficult'][jmax]
+      gt_ind[inds] = nr_gt + jmax
+      nr_gt += len(BBGT)
+
+    # mark TPs and FPs
+    matched = ovmax > ovthresh
+    fp[~matched] = 1.
+    claims = np.where(matched & ~difficult)[0]
+    first_claims = claims[np.unique(gt_ind[claims], return_index=True)[1]]
+    fp[claims] = 1.
+    fp[first_claims] = 0.
+    tp[first_claims] = 1.
 
   # compute precision recall
   fp = np.cumsum(fp)
@@ -270,3 +330,79 @@ def voc_eval(detpath,
   ap = voc_ap(rec, prec, use_07_metric)
 
   return rec, prec, ap
+
+
+def voc_eval_all(detpath,
+                 annopath,
+                 imagesetfile,
+                 classnames,
+                 cachedir,
+                 ovthresh=0.5,
+                 use_07_metric=False,
+                 image_sizes=None):
+  """results = voc_eval_all(detpath, annopath, imagesetfile, classnames,
+                            cachedir, [ovthresh], [use_07_metric],
+                            [image_sizes])
+
+  voc_eval for several classes at once: the ground truth is read once and
+  split by class in one pass, a .npz detections file is loaded once.
+  image_sizes[imagename] = (width, height) scales the DeepScores boxes, see
+  load_annotations.
+  Returns results[classname] = (rec, prec, ap).
+  """
+  imagenames, recs = load_annotations(annopath, imagesetfile, cachedir,
+                                      "DeepScores" in detpath, image_sizes)
+  class_recs, npos = group_by_class(imagenames, recs, classnames)
+  if detpath.endswith('.npz'):
+    dets = load_detections_file(detpath)
+
+  results = {}
+  for classname in classnames:
+    # read dets
+    if detpath.endswith('.npz'):
+      image_ids, confidence, BB = load_class_detections(detpath, classname,
+                                                        dets)
+    else:
+      image_ids, confidence, BB = load_text_detections(
+        detpath.format(classname))
+    results[classname] = eval_class(class_recs[classname], npos[classname],
+                                    image_ids, confidence, BB, ovthresh,
+                                    use_07_metric)
+  return results
+
+
+def voc_eval(detpath,
+             annopath,
+             imagesetfile,
+             classname,
+             cachedir,
+             ovthresh=0.5,
+             use_07_metric=False):
+  """rec, prec, ap = voc_eval(detpath,
+                              annopath,
+                              imagesetfile,
+                              classname,
+                              [ovthresh],
+                              [use_07_metric])
+
+  Top level function that does the PASCAL VOC evaluation.
+
+  detpath: Path to detections
+      detpath.format(classname) should produce the detection results file,
+      or a .npz file written by write_detections_file holding all classes.
+  annopath: Path to annotations
+      annopath.format(imagename) should be the xml annotations file.
+  imagesetfile: Text file containing the list of images, one image per line.
+  classname: Category name (duh)
+  cachedir: Directory for caching the annotations
+  [ovthresh]: Overlap threshold (default = 0.5)
+  [use_07_metric]: Whether to use VOC07's 11 point AP computation
+      (default False)
+  """
+  # assumes detections are in detpath.format(classname)
+  # assumes annotations are in annopath.format(imagename)
+  # assumes imagesetfile is a text file with each line an image name
+  # cachedir caches the parsed annotations per file
+  results = voc_eval_all(detpath, annopath, imagesetfile, [classname],
+                         cachedir, ovthresh, use_07_metric)
+  return results[classname]
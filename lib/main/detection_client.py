@@ -0,0 +1,32 @@
+import numpy as np
+import json
+import socket
+from six.moves import http_client
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    def __init__(self, unix_socket, timeout=None):
+        http_client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_socket)
+
+
+def get_connection(host="127.0.0.1", port=8500, unix_socket="", timeout=None):
+    if unix_socket != "":
+        return UnixHTTPConnection(unix_socket, timeout=timeout)
+    return http_client.HTTPConnection(host, port, timeout=timeout)
+
+
+def request_detection(connection, encoded_img):
+    """
+    Send an encoded page to a running server, returns the boxes as N x 6 array of (x1, y1, x2, y2, class, score).
+    """
+    connection.request("POST", "/detect", encoded_img, {"Content-Type": "application/octet-stream"})
+    response = connection.getresponse()
+    content = json.loads(response.read().decode("utf-8"))
+    if response.status != 200:
+        raise RuntimeError("detection server returned {:d}: {:s}".format(response.status, content["error"]))
+    return np.asarray(content["boxes"], dtype=np.float32).reshape(-1, 6)
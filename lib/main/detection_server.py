@@ -0,0 +1,279 @@
+import numpy as np
+import os
+import io
+import json
+import threading
+import time
+from PIL import Image
+import sys
+sys.path.insert(0,os.path.dirname(__file__)[:-4])
+from six.moves import queue, BaseHTTPServer, socketserver
+from multiprocessing.pool import ThreadPool
+from datasets.factory import get_imdb
+from dws_detector import DWSDetector, get_page, get_padded_shape
+from dws_transform import perform_dws
+from utils.timer import StageTimer
+import argparse
+
+
+class DetectionRequest(object):
+    """
+    A page waiting for its boxes. result() blocks until the service has processed the page.
+    """
+    def __init__(self, img):
+        self.img = img
+        self.arrival = time.time()
+        self.boxes = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, boxes=None, error=None):
+        self.boxes = boxes
+        self.error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("detection request timed out")
+        if self.error is not None:
+            raise RuntimeError("detection failed: " + str(self.error))
+        return self.boxes
+
+
+class DetectionService(object):
+    """
+    Runs a DWSDetector for concurrent callers.
+
+    Requests are collected by a single batching thread: a batch is closed once it holds max_batch_size pages or the
+    oldest page has waited max_latency seconds. The pages of a batch are grouped by the detector's shape buckets,
+    every group is one session call. The dws post-processing runs on post_workers threads, so the next batch can
+    enter the network meanwhile.
+
+    Queue depth and request counters are returned by stats(), together with percentiles of the time requests wait
+    for their batch ("queue_wait"), the session runs ("session_run") and the end to end latency ("latency"), taken
+    over the last timing_window entries of every stage.
+    """
+    def __init__(self, net, max_batch_size=4, max_latency=0.02, cutoff=3, min_ccoponent_size=4, post_workers=2,
+                 min_score=0, timing_window=10000):
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.cutoff = cutoff
+        self.min_ccoponent_size = min_ccoponent_size
+        self.min_score = min_score
+
+        self.requests = queue.Queue()
+        # percentiles over the last timing_window requests of every stage
+        self.timer = StageTimer(enabled=True, window=timing_window)
+        self.counters = {'requests': 0, 'finished': 0, 'errors': 0, 'batches': 0, 'session_runs': 0,
+                         'max_queue_depth': 0}
+        self._lock = threading.Lock()
+        self.post_pool = ThreadPool(max(post_workers, 1))
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, img):
+        request = DetectionRequest(get_page(img))
+        self.requests.put(request)
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self.requests.qsize())
+        return request
+
+    def detect(self, img, timeout=None):
+        """
+        Classify a single page, blocking until its boxes are ready. Safe to call from many threads.
+        """
+        return self.submit(img).result(timeout)
+
+    def stop(self):
+        self.requests.put(None)
+        self.worker.join()
+        self.post_pool.close()
+        self.post_pool.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = self.requests.qsize()
+        stats['in_flight'] = stats['requests'] - stats['finished'] - stats['errors']
+        stats['timings'] = self.timer.summary()
+        return stats
+
+    def _next_batch(self):
+        request = self.requests.get()
+        if request is None:
+            return []
+        batch = [request]
+        deadline = request.arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            # pages that queued up during the last session run are taken even if the deadline has passed
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    request = self.requests.get(timeout=remaining)
+                else:
+                    request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch, stop with the next one
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                return
+            start_time = time.time()
+            for request in batch:
+                self.timer.add("queue_wait", start_time - request.arrival)
+
+            buckets = dict()
+            for request in batch:
+                buckets.setdefault(get_padded_shape(request.img.shape, self.net.bucket_step), []).append(request)
+            with self._lock:
+                self.counters['batches'] += 1
+                self.counters['session_runs'] += len(buckets)
+
+            for requests in buckets.values():
+                try:
+                    with self.timer.stage("session_run"):
+                        batch_maps = self.net.predict_batch_maps([request.img for request in requests])
+                except Exception as e:
+                    for request in requests:
+                        self._finish(request, error=e)
+                    continue
+                for request, maps in zip(requests, batch_maps):
+                    self.post_pool.apply_async(self._post_process, (request, maps))
+
+    def _post_process(self, request, maps):
+        try:
+            boxes = perform_dws(maps[0], maps[1], maps[2], self.cutoff, self.min_ccoponent_size,
+                                min_score=self.min_score)
+        except Exception as e:
+            self._finish(request, error=e)
+            return
+        self._finish(request, boxes=boxes)
+
+    def _finish(self, request, boxes=None, error=None):
+        with self._lock:
+            self.counters['finished' if error is None else 'errors'] += 1
+        self.timer.add("latency", time.time() - request.arrival)
+        request.finish(boxes, error)
+
+
+class DetectionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /detect with an encoded page image (png, jpg, ...) as body returns
+    {"boxes": [[x1, y1, x2, y2, class, score], ...]},
+    GET /stats returns the counters of the service.
+    """
+    def do_POST(self):
+        if self.path != "/detect":
+            self._send_json(404, {"error": "unknown path " + self.path})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            img = np.asarray(Image.open(io.BytesIO(body)).convert('L'))
+        except IOError as e:
+            self._send_json(400, {"error": "could not decode image: " + str(e)})
+            return
+        try:
+            boxes = self.server.service.detect(img)
+        except RuntimeError as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"boxes": np.asarray(boxes).tolist()})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._send_json(404, {"error": "unknown path " + self.path})
+            return
+        self._send_json(200, self.server.service.stats())
+
+    def _send_json(self, code, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no (host, port) address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        # one line per request floods the log under load
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=8500, unix_socket=""):
+    """
+    Serve the service over HTTP, on a unix socket if one is given and on host:port otherwise.
+    """
+    if unix_socket != "":
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, DetectionRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), DetectionRequestHandler)
+    server.service = service
+    return server
+
+
+def main(parsed):
+    parsed = parsed[0]
+    imdb = get_imdb(parsed.test_set)
+    warmup_shapes = None
+    if parsed.warmup_shapes != "":
+        warmup_shapes = [tuple(int(x) for x in shape.split("x")) for shape in parsed.warmup_shapes.split(",")]
+    net = DWSDetector(imdb, frozen_graph=parsed.frozen_graph if parsed.frozen_graph != "" else None,
+                      bucket_step=parsed.bucket_step, warmup_shapes=warmup_shapes)
+    service = DetectionService(net, max_batch_size=parsed.max_batch_size, max_latency=parsed.max_latency_ms / 1000.0,
+                               post_workers=parsed.post_workers, min_score=parsed.min_score,
+                               timing_window=parsed.timing_window)
+    server = make_server(service, parsed.host, parsed.port, parsed.unix_socket)
+    print("Serving detections on " + (parsed.unix_socket if parsed.unix_socket != ""
+                                      else "{:s}:{:d}".format(parsed.host, parsed.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test_set", type=str, default="DeepScores_2017_debug", help="dataset the model was trained on, defines the classes")
+    parser.add_argument("--frozen_graph", type=str, default="", help="load the detector from a graph written by export_frozen_graph.py instead of the checkpoint")
+    parser.add_argument("--bucket_step", type=int, default=160, help="pages are padded to multiples of this (a multiple of 160), larger steps like 320 let fewer distinct input shapes reach the network but widen the white margin, detections near the right and bottom page edges can change slightly")
+    parser.add_argument("--warmup_shapes", type=str, default="", help="page shapes as HEIGHTxWIDTH, comma separated, whose buckets are run once before serving")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="maximum number of pages per batch")
+    parser.add_argument("--max_latency_ms", type=float, default=20, help="maximum time a page waits for its batch to fill")
+    parser.add_argument("--min_score", type=float, default=0, help="drop detections with a lower score (mean energy times class purity)")
+    parser.add_argument("--timing_window", type=int, default=10000, help="number of recent requests the latency percentiles in /stats are computed over")
+    parser.add_argument("--post_workers", type=int, default=2, help="threads running the dws post-processing")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address the http server listens on")
+    parser.add_argument("--port", type=int, default=8500, help="port the http server listens on")
+    parser.add_argument("--unix_socket", type=str, default="", help="serve on this unix socket instead of host:port")
+
+    parsed = parser.parse_known_args()
+    main(parsed)
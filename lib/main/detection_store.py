@@ -0,0 +1,115 @@
+import os
+import numpy as np
+
+
+class DetectionWriter:
+    """
+    Streams detections to disk in chunks of finished images.
+
+    Every chunk is one .npz file holding three columns:
+      image_names: names of the images processed in this chunk, including images without detections
+      box_images:  for every box the position of its image in image_names
+      boxes:       N x 6 float32 array of (x1, y1, x2, y2, class, score)
+    Chunks are written atomically, so after a crash all complete chunks are valid and processing can resume.
+    """
+    def __init__(self, det_dir, chunk_size=100, resume=False):
+        self.det_dir = det_dir
+        self.chunk_size = chunk_size
+        if not os.path.exists(det_dir):
+            os.makedirs(det_dir)
+
+        self.nr_chunks = len(get_chunk_files(det_dir))
+        if resume:
+            self.processed_images = set(load_detections(det_dir)[0])
+        else:
+            for f in get_chunk_files(det_dir):
+                os.remove(f)
+            self.nr_chunks = 0
+            self.processed_images = set()
+        self._reset_chunk()
+
+    def _reset_chunk(self):
+        self.image_names = []
+        self.box_images = []
+        self.boxes = []
+
+    def add(self, image_name, boxes):
+        self.box_images.append(np.full(len(boxes), len(self.image_names), dtype=np.int32))
+        self.boxes.append(np.asarray(boxes, dtype=np.float32).reshape(-1, 6))
+        self.image_names.append(image_name)
+        self.processed_images.add(image_name)
+        if len(self.image_names) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.image_names) == 0:
+            return
+        chunk_file = os.path.join(self.det_dir, 'detections_{:05d}.npz'.format(self.nr_chunks))
+        with open(chunk_file + '.tmp', 'wb') as f:
+            np.savez(f, image_names=np.array(self.image_names), box_images=np.concatenate(self.box_images),
+                     boxes=np.concatenate(self.boxes))
+        os.rename(chunk_file + '.tmp', chunk_file)
+        self.nr_chunks += 1
+        self._reset_chunk()
+
+    def close(self):
+        self.flush()
+
+
+def get_chunk_files(det_dir):
+    if not os.path.exists(det_dir):
+        return []
+    return sorted(os.path.join(det_dir, f) for f in os.listdir(det_dir)
+                  if f.startswith('detections_') and f.endswith('.npz'))
+
+
+def load_chunk(chunk_file):
+    with np.load(chunk_file) as chunk:
+        return dict(chunk.items())
+
+
+def load_detections(det_dirs):
+    """
+    Load all chunks of one or several detection directories into columns: image names and per box image name index
+    and box.
+    """
+    if not isinstance(det_dirs, list):
+        det_dirs = [det_dirs]
+    image_names, box_images, boxes = [], [], []
+    nr_images = 0
+    for chunk_file in [f for det_dir in det_dirs for f in get_chunk_files(det_dir)]:
+        chunk = load_chunk(chunk_file)
+        image_names.append(chunk["image_names"])
+        box_images.append(chunk["box_images"] + nr_images)
+        boxes.append(chunk["boxes"])
+        nr_images += len(chunk["image_names"])
+    if nr_images == 0:
+        return np.zeros(0, dtype=str), np.zeros(0, dtype=np.int32), np.zeros((0, 6), dtype=np.float32)
+    return np.concatenate(image_names), np.concatenate(box_images), np.concatenate(boxes)
+
+
+def load_all_boxes(det_dirs, imdb):
+    """
+    Rebuild all_boxes[class][image] as expected by imdb.evaluate_detections from one or several (e.g. one per shard)
+    detection directories. Every entry is a slice of one sorted box array, entries without detections are [].
+    """
+    image_names, box_images, boxes = load_detections(det_dirs)
+    all_boxes = [[[] for _ in range(imdb.num_images)]
+                 for _ in range(imdb.num_classes)]
+
+    # map the stored image names to positions in the imdb, images no longer in the imdb are dropped
+    image_to_ind = dict(zip(imdb.image_index, range(imdb.num_images)))
+    name_to_ind = np.array([image_to_ind.get(name, -1) for name in image_names], dtype=np.int64)
+    box_inds = name_to_ind[box_images] if len(boxes) > 0 else np.zeros(0, dtype=np.int64)
+    valid = box_inds >= 0
+    boxes, box_inds = boxes[valid], box_inds[valid]
+
+    # sort by class and image, every (class, image) group is one contiguous slice
+    keys = boxes[:, 4].astype(np.int64) * imdb.num_images + box_inds
+    order = np.argsort(keys, kind='mergesort')
+    boxes, keys = boxes[order], keys[order]
+    group_keys, starts = np.unique(keys, return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    for key, start, end in zip(group_keys, starts, ends):
+        all_boxes[key // imdb.num_images][key % imdb.num_images] = boxes[start:end]
+    return all_boxes
@@ -1,8 +1,11 @@
 from __future__ import print_function
+import threading
+import collections
 import numpy as np
 import tensorflow as tf
 from models.dwd_net import build_dwd_net
 from dws_transform import perform_dws
+from utils.timer import stage_timer
 from PIL import Image
 from config import cfg
 
@@ -10,8 +13,16 @@ np.random.seed(314)
 tf.set_random_seed(314)
 
 
+# names of the input and output tensors in the inference graph
+INPUT_NAME = "input"
+OUTPUT_MAP_NAMES = ["energy_map", "class_map", "bbox_map"]
+
+# canvases kept per thread, the least recently used one is dropped first
+MAX_CANVASES = 8
+
+
 class DWSDetector:
-    def __init__(self, imdb):
+    def __init__(self, imdb, frozen_graph=None, nr_threads=None, bucket_step=160, warmup_shapes=None):
         self.model_path = "trained_models/music/RefineNet-Res101/semseg"
         self.model_name = "RefineNet-Res101"
         self.saved_net = 'backbone'
@@ -23,45 +34,262 @@ class DWSDetector:
 
         self.tf_session = None
         self.root_dir = cfg.ROOT_DIR
-        self.sess = tf.Session()
+        self.network_heads = None
+        self.graph = tf.Graph()
+        if nr_threads is None:
+            config = tf.ConfigProto()
+        else:
+            # limit the threads used by this detector, e.g. when several detectors share a machine
+            config = tf.ConfigProto(intra_op_parallelism_threads=nr_threads, inter_op_parallelism_threads=nr_threads)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        with self.graph.as_default():
+            if frozen_graph is None:
+                self.load_checkpoint(imdb.num_classes)
+            else:
+                self.load_frozen_graph(frozen_graph)
+        self.tf_session = self.sess
+
+        # pages are padded to multiples of bucket_step, every bucket and batch size keeps its canvas between calls.
+        # The default 160 pads only what the network needs, larger steps let fewer input shapes reach the network
+        # but widen the white margin around the page, which can change detections near the page edges.
+        # Canvases are kept per thread, so that threads sharing the detector never run the network on each other's
+        # pages
+        assert bucket_step % 160 == 0, "bucket step has to be a multiple of 160"
+        self.bucket_step = bucket_step
+        self._thread_canvases = threading.local()
+        if warmup_shapes is not None:
+            self.warm_up(warmup_shapes)
+
+    def load_checkpoint(self, num_classes):
         print('Loading model')
-        self.input = tf.placeholder(tf.float32, shape=[None, None, None, 1])
-        self.network_heads, self.init_fn = build_dwd_net(self.input, model=self.model_name, num_classes=imdb.num_classes,
-                                               pretrained_dir="", substract_mean=False)
+        self.input = tf.placeholder(tf.float32, shape=[None, None, None, 1], name=INPUT_NAME)
+        # only build the heads that are fetched, at the last level
+        inference_heads = {"stamp_energy": [self.energy_loss], "stamp_class": [self.class_loss],
+                           "stamp_bbox": [self.bbox_loss]}
+        self.network_heads, self.init_fn = build_dwd_net(self.input, model=self.model_name, num_classes=num_classes,
+                                               pretrained_dir="", substract_mean=False,
+                                               heads=inference_heads, levels=[-1])
+        self.output_maps = self.get_output_maps(num_classes)
         self.saver = tf.train.Saver(max_to_keep=1000)
         self.sess.run(tf.global_variables_initializer())
         print("Loading weights")
         self.saver.restore(self.sess, self.root_dir + "/" + self.model_path + "/" + self.saved_net)
-        self.tf_session = self.sess
-
-    def classify_img(self, img, cutoff=0, min_ccoponent_size=0):
-        if len(img.shape) < 4:
-            img = np.expand_dims(np.expand_dims(img, -1), 0)
 
-        y_mulity = int(np.ceil(img.shape[1] / 160.0))
-        x_mulity = int(np.ceil(img.shape[2] / 160.0))
-        canv = np.ones([y_mulity * 160, x_mulity * 160], dtype=np.uint8) * 255
-        canv = np.expand_dims(np.expand_dims(canv, -1), 0)
+    def load_frozen_graph(self, frozen_graph):
+        """
+        Load the inference graph written by export_frozen_graph, no variables have to be initialized or restored.
+        """
+        print('Loading frozen graph ' + frozen_graph)
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        tensors = tf.import_graph_def(graph_def, name="",
+                                      return_elements=[INPUT_NAME + ":0"] + [x + ":0" for x in OUTPUT_MAP_NAMES])
+        self.input = tensors[0]
+        self.output_maps = tensors[1:]
 
-        canv[0, 0:img.shape[1], 0:img.shape[2]] = img[0]
-        pred_energy, pred_class, pred_bbox = self.tf_session.run(
-            [self.network_heads["stamp_energy"][self.energy_loss][-1], self.network_heads["stamp_class"][self.class_loss][-1],
-             self.network_heads["stamp_bbox"][self.bbox_loss][-1]], feed_dict={self.input: canv})
+    def export_frozen_graph(self, frozen_graph):
+        """
+        Write the restored inference graph as a single GraphDef: variables are converted to constants, everything
+        that is not needed to compute the output maps is stripped and constant expressions are folded.
+        """
+        from tensorflow.tools.graph_transforms import TransformGraph
 
-        if self.energy_loss == "softmax":
-            pred_energy = np.argmax(pred_energy, axis=3)
+        graph_def = tf.graph_util.convert_variables_to_constants(self.sess, self.graph.as_graph_def(),
+                                                                 OUTPUT_MAP_NAMES)
+        graph_def = TransformGraph(graph_def, [INPUT_NAME], OUTPUT_MAP_NAMES,
+                                   ["strip_unused_nodes", "remove_nodes(op=Identity, op=CheckNumerics)",
+                                    "fold_constants(ignore_errors=true)", "fold_batch_norms", "fold_old_batch_norms"])
+        with tf.gfile.GFile(frozen_graph, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        print("Wrote frozen graph with {:d} nodes to {:s}".format(len(graph_def.node), frozen_graph))
 
-        if self.class_loss == "softmax":
-            pred_class = np.argmax(pred_class, axis=3)
+    def classify_img(self, img, cutoff=0, min_ccoponent_size=0, min_score=0):
+        pred_energy, pred_class, pred_bbox = self.predict_page_maps(get_page(img))
 
-        if self.bbox_loss == "softmax":
-            pred_bbox = np.argmax(pred_bbox, axis=3)
-
-        dws_list = perform_dws(pred_energy, pred_class, pred_bbox,cutoff, min_ccoponent_size)
+        dws_list = perform_dws(pred_energy, pred_class, pred_bbox,cutoff, min_ccoponent_size, min_score=min_score)
         #save_images(img, dws_list, True, False)
 
         return dws_list
 
+    def predict_page_maps(self, img):
+        """
+        Pad a single [height, width] page to its bucket shape and run the network on it. The maps are cropped to
+        the page padded to a multiple of 160.
+        """
+        with stage_timer.stage("padding"):
+            canv = self.fill_canvas(img, get_padded_shape(img.shape, self.bucket_step))
+
+        maps = self.predict_maps(canv)
+        y_size, x_size = get_padded_shape(img.shape)
+        return [m[:, 0:y_size, 0:x_size] for m in maps]
+
+    def fill_canvas(self, img, canv_shape):
+        """
+        Copy a page into the white [1, height, width, 1] canvas kept for canv_shape.
+        """
+        return self.fill_batch_canvas([img], canv_shape)
+
+    def fill_batch_canvas(self, images, canv_shape):
+        """
+        Copy pages into the white [len(images), height, width, 1] canvas kept for this batch size and canv_shape.
+        Only the area covered by the previous pages has to be whitened again.
+        """
+        canvases = self.get_canvases()
+        key = (len(images), int(canv_shape[0]), int(canv_shape[1]))
+        if key in canvases:
+            canv, used_shapes = canvases.pop(key)
+        else:
+            canv, used_shapes = np.ones([key[0], key[1], key[2], 1], dtype=np.uint8) * 255, [(0, 0)] * key[0]
+            if len(canvases) >= MAX_CANVASES:
+                canvases.popitem(last=False)
+        canvases[key] = canv, used_shapes
+        for k, img in enumerate(images):
+            y_used, x_used = used_shapes[k]
+            canv[k, 0:y_used, 0:x_used] = 255
+            canv[k, 0:img.shape[0], 0:img.shape[1], 0] = img
+            used_shapes[k] = img.shape[:2]
+        return canv
+
+    def get_canvases(self):
+        """
+        The canvases of the calling thread, by (batch size, height, width), in order of last use. At most
+        MAX_CANVASES are kept, tiled pages and varying batch sizes would otherwise add new shapes forever.
+        """
+        if not hasattr(self._thread_canvases, "canvases"):
+            self._thread_canvases.canvases = collections.OrderedDict()
+        return self._thread_canvases.canvases
+
+    def warm_up(self, page_shapes):
+        """
+        Run the network once on every bucket the given page shapes fall into, so that the first real page of a
+        bucket is not slowed down by TensorFlow setting up the new input shape.
+        """
+        for canv_shape in sorted(set(get_padded_shape(shape, self.bucket_step) for shape in page_shapes)):
+            print("Warming up input shape {:d}x{:d}".format(canv_shape[0], canv_shape[1]))
+            self.predict_maps(self.fill_canvas(np.zeros((0, 0), dtype=np.uint8), canv_shape))
+
+    def classify_batch(self, images, cutoff=0, min_ccoponent_size=0, batch_size=4, min_score=0):
+        """
+        Classify a list of pages, running up to batch_size pages of similar size in one session call.
+        Returns one box array per page, in the order of images.
+        """
+        images = [get_page(img) for img in images]
+        # sort by padded shape so that each batch wastes as little padding as possible
+        order = sorted(range(len(images)), key=lambda i: get_padded_shape(images[i].shape))
+
+        dws_lists = [None] * len(images)
+        for start in range(0, len(order), batch_size):
+            batch_inds = order[start:start + batch_size]
+            batch_maps = self.predict_batch_maps([images[i] for i in batch_inds])
+            for i, (pred_energy, pred_class, pred_bbox) in zip(batch_inds, batch_maps):
+                dws_lists[i] = perform_dws(pred_energy, pred_class, pred_bbox, cutoff, min_ccoponent_size,
+                                           min_score=min_score)
+        return dws_lists
+
+    def predict_batch_maps(self, images):
+        """
+        Run the network on a list of [height, width] pages in one session call. Returns the energy, class and bbox
+        maps of every page, each page only sees the maps of its own padded canvas.
+        """
+        padded_shapes = [get_padded_shape(img.shape) for img in images]
+        canv_shape = np.max([get_padded_shape(img.shape, self.bucket_step) for img in images], axis=0)
+        with stage_timer.stage("padding"):
+            canv = self.fill_batch_canvas(images, canv_shape)
+
+        batch_maps = self.predict_maps(canv)
+        return [[m[k, 0:y_size, 0:x_size] for m in batch_maps] for k, (y_size, x_size) in enumerate(padded_shapes)]
+
+    def classify_img_tiled(self, img, cutoff=0, min_ccoponent_size=0, tile_size=1600, tile_overlap=320, min_score=0):
+        """
+        Classify a page tile by tile, the stitched maps are post-processed as one page so that components
+        crossing tile borders are labeled as a single component.
+        """
+        pred_energy, pred_class, pred_bbox = self.predict_maps_tiled(get_page(img), tile_size, tile_overlap)
+        return perform_dws(pred_energy, pred_class, pred_bbox, cutoff, min_ccoponent_size, min_score=min_score)
+
+    def predict_maps_tiled(self, img, tile_size=1600, tile_overlap=320):
+        """
+        Run the network on overlapping tiles of a page and stitch the energy, class and bbox maps. Each page pixel
+        is taken from the tile in which it lies furthest from the border, network memory is bounded by tile_size.
+        """
+        assert tile_size % 160 == 0, "tile size has to be a multiple of 160"
+        assert 0 <= tile_overlap < tile_size, "tile overlap has to be smaller than the tile size"
+        canv_shape = get_padded_shape(img.shape)
+        y_tiles = get_tiles(canv_shape[0], tile_size, tile_overlap)
+        x_tiles = get_tiles(canv_shape[1], tile_size, tile_overlap)
+
+        maps = None
+        for y_start, y_size, y_from, y_to in y_tiles:
+            for x_start, x_size, x_from, x_to in x_tiles:
+                canv = self.fill_canvas(img[y_start:y_start + y_size, x_start:x_start + x_size], (y_size, x_size))
+
+                tile_maps = self.predict_maps(canv)
+                if maps is None:
+                    maps = [np.zeros((1,) + canv_shape + m.shape[3:], dtype=m.dtype) for m in tile_maps]
+                for page_map, tile_map in zip(maps, tile_maps):
+                    page_map[0, y_from:y_to, x_from:x_to] = \
+                        tile_map[0, y_from - y_start:y_to - y_start, x_from - x_start:x_to - x_start]
+        return maps
+
+    def predict_maps(self, canv):
+        """
+        Run the network on a batch of padded canvases and return the energy, class and bbox maps.
+        """
+        # includes the in-graph argmax of the softmax heads
+        with stage_timer.stage("session_run"):
+            pred_energy, pred_class, pred_bbox = self.tf_session.run(self.output_maps, feed_dict={self.input: canv})
+        return pred_energy, pred_class, pred_bbox
+
+    def get_output_maps(self, num_classes):
+        """
+        Build the tensors fetched at inference time from the last level of the energy, class and bbox heads.
+        Softmax heads are reduced to their argmax inside the graph and cast to the smallest sufficient integer type,
+        so that only compact maps are copied out of the session.
+        """
+        output_maps = []
+        for head, loss, nr_levels, name in [("stamp_energy", self.energy_loss, cfg.TRAIN.MAX_ENERGY, OUTPUT_MAP_NAMES[0]),
+                                            ("stamp_class", self.class_loss, num_classes, OUTPUT_MAP_NAMES[1]),
+                                            ("stamp_bbox", self.bbox_loss, 2, OUTPUT_MAP_NAMES[2])]:
+            logits = self.network_heads[head][loss][-1]
+            if loss == "softmax":
+                out_type = tf.uint8 if nr_levels <= 256 else tf.int16
+                output_maps.append(tf.cast(tf.argmax(logits, axis=3, output_type=tf.int32), out_type, name=name))
+            else:
+                output_maps.append(tf.identity(logits, name=name))
+        return output_maps
+
+
+def get_page(img):
+    # accept [height, width], [height, width, 1] and [1, height, width, 1] pages
+    if len(img.shape) == 4:
+        img = img[0]
+    if len(img.shape) == 3:
+        img = img[:, :, 0]
+    return img
+
+
+def get_tiles(length, tile_size, tile_overlap):
+    """
+    Split a padded axis of the given length into overlapping tiles.
+    Returns (start, size, from, to) per tile, where [from, to) is the part of the axis the tile is responsible for.
+    """
+    if length <= tile_size:
+        return [(0, length, 0, length)]
+    starts = list(range(0, length - tile_size + 1, tile_size - tile_overlap))
+    if starts[-1] + tile_size < length:
+        # last tile is aligned with the end of the axis
+        starts.append(length - tile_size)
+
+    # borders between neighbouring tiles lie in the middle of their overlap
+    cuts = [0] + [(starts[k] + tile_size + starts[k + 1]) // 2 for k in range(len(starts) - 1)] + [length]
+    return [(starts[k], tile_size, cuts[k], cuts[k + 1]) for k in range(len(starts))]
+
+
+def get_padded_shape(shape, multiple=160):
+    # the network input has to be a multiple of 160 in both dimensions, larger multiples are used as shape buckets
+    return (int(np.ceil(shape[0] / float(multiple))) * multiple, int(np.ceil(shape[1] / float(multiple))) * multiple)
+
 
 def get_images(data, gt_boxes=None, gt=False, text=False):
     if data.shape[-1] == 1:
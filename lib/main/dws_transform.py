@@ -4,61 +4,169 @@ import sys
 import math, random
 from itertools import product
 from utils.ufarray import *
+from utils.timer import stage_timer
+from utils.nms import nms
 import numpy as np
-
-def perform_dws(dws_energy, class_map, bbox_map,cutoff=0,min_ccoponent_size=0, return_ccomp_img = False):
-    bbox_list = []
-
+import scipy.ndimage
+import cv2
+
+def perform_dws(dws_energy, class_map, bbox_map,cutoff=0,min_ccoponent_size=0, return_ccomp_img = False, cc_backend="scipy",
+                min_score=0):
+    """
+    Turn the predicted energy, class and bbox maps into detections.
+
+    Returns an (N, 6) float32 array of boxes [xmin, ymin, xmax, ymax, class, score], one row per connected
+    component of the energy map above cutoff that has at least min_ccoponent_size pixels and a score of at least
+    min_score. The score is the mean energy level of the component times the fraction of its pixels voting for
+    its class.
+    """
     dws_energy = np.squeeze(dws_energy)
     class_map = np.squeeze(class_map)
     bbox_map = np.squeeze(bbox_map)
 
-    # Treshhold and binarize dws energy
-    binar_energy = (dws_energy <= cutoff) * 255
-
-    # get connected components
-    labels, out_img = find_connected_comp(np.transpose(binar_energy)) # works with inverted indices
-    # invert labels dict
-    labels_inv = {}
-    for k, v in labels.iteritems():
-        labels_inv[v] = labels_inv.get(v, [])
-        labels_inv[v].append(k)
-
-
-    # filter components that are too small
-    for key in labels_inv.keys():
-        # print(key)
-        # print(len(labels_inv[key]))
-        if len(labels_inv[key]) < min_ccoponent_size:
-            del labels_inv[key]
-
-
-    for key in labels_inv.keys():
-        # add additional dict structure to each component and convert to numpy array
-        labels_inv[key] = dict(pixel_coords=np.asanyarray(labels_inv[key]))
-        # use average over all pixel coordinates
-        labels_inv[key]["center"] = np.average(labels_inv[key]["pixel_coords"],0).astype(int)
-        # mayority vote for class --> transposed
-        labels_inv[key]["class"] = np.bincount(class_map[labels_inv[key]["pixel_coords"][:, 1], labels_inv[key]["pixel_coords"][:, 0]]).argmax()
-        # average for box size --> transposed
-        #labels_inv[key]["bbox_size"] = np.average(bbox_map[labels_inv[key]["pixel_coords"][:, 1], labels_inv[key]["pixel_coords"][:, 0]],0).astype(int)
-        labels_inv[key]["bbox_size"] = np.amax(
-            bbox_map[labels_inv[key]["pixel_coords"][:, 1], labels_inv[key]["pixel_coords"][:, 0]], 0).astype(int)
-
-        # produce bbox element, append to list
-        bbox = []
-        bbox.append(int(np.round(labels_inv[key]["center"][0] - (labels_inv[key]["bbox_size"][1]/2.0), 0))) # xmin
-        bbox.append(int(np.round(labels_inv[key]["center"][1] - (labels_inv[key]["bbox_size"][0]/2.0), 0))) # ymin
-        bbox.append(int(np.round(labels_inv[key]["center"][0] + (labels_inv[key]["bbox_size"][1]/2.0), 0))) # xmax
-        bbox.append(int(np.round(labels_inv[key]["center"][1] + (labels_inv[key]["bbox_size"][0]/2.0), 0))) # ymax
-        bbox.append(int(labels_inv[key]["class"]))
-        bbox_list.append(bbox)
+    # get connected components of the thresholded dws energy
+    with stage_timer.stage("connected_components"):
+        labels, nr_components = label_components(dws_energy > cutoff, backend=cc_backend)
+
+    with stage_timer.stage("box_assembly"):
+        bbox_list = component_boxes(labels, nr_components, dws_energy, class_map, bbox_map, min_ccoponent_size,
+                                    min_score)
 
     if return_ccomp_img:
-        return bbox_list, out_img
+        # debug visualization, only rendered on request
+        return bbox_list, colorize_components(labels, nr_components)
     return bbox_list
 
 
+def component_boxes(labels, nr_components, dws_energy, class_map, bbox_map, min_ccoponent_size=0, min_score=0):
+    """
+    Compute center, majority class, maximal bbox size and score of all components of a label image in one pass
+    over the foreground pixels and assemble them into an (N, 6) float32 box array.
+    """
+    if nr_components == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    ys, xs = np.nonzero(labels)
+    comp_ids = labels[ys, xs]
+    counts = np.bincount(comp_ids, minlength=nr_components + 1)
+
+    # use average over all pixel coordinates
+    center_x = (np.bincount(comp_ids, weights=xs, minlength=nr_components + 1) / np.maximum(counts, 1)).astype(int)
+    center_y = (np.bincount(comp_ids, weights=ys, minlength=nr_components + 1) / np.maximum(counts, 1)).astype(int)
+
+    # mayority vote for class, ties go to the lowest class id
+    pixel_classes = class_map[ys, xs].astype(np.int64)
+    nr_classes = int(pixel_classes.max()) + 1
+    class_votes = np.bincount(comp_ids * nr_classes + pixel_classes, minlength=(nr_components + 1) * nr_classes)
+    class_votes = class_votes.reshape(nr_components + 1, nr_classes)
+    classes = class_votes.argmax(axis=1)
+
+    # score: mean energy level times class purity
+    energy_sums = np.bincount(comp_ids, weights=dws_energy[ys, xs], minlength=nr_components + 1)
+    mean_energy = energy_sums / np.maximum(counts, 1)
+    purity = class_votes.max(axis=1) / np.maximum(counts, 1).astype(np.float64)
+    scores = mean_energy * purity
+
+    # maximum for box size, reduced over the pixels sorted by component
+    order = np.argsort(comp_ids, kind="mergesort")
+    starts = np.cumsum(counts)[:-1]
+    bbox_size = np.zeros((nr_components + 1, 2), dtype=int)
+    bbox_size[1:] = np.maximum.reduceat(bbox_map[ys[order], xs[order]], starts, axis=0).astype(int)
+
+    # filter components that are too small or not confident enough
+    keep = np.where((counts >= max(min_ccoponent_size, 1)) & (scores >= min_score))[0]
+    keep = keep[keep > 0]
+    center_x, center_y, bbox_size, classes = center_x[keep], center_y[keep], bbox_size[keep], classes[keep]
+
+    boxes = np.empty((len(keep), 6), dtype=np.float32)
+    boxes[:, 0] = np.round(center_x - (bbox_size[:, 1] / 2.0), 0) # xmin
+    boxes[:, 1] = np.round(center_y - (bbox_size[:, 0] / 2.0), 0) # ymin
+    boxes[:, 2] = np.round(center_x + (bbox_size[:, 1] / 2.0), 0) # xmax
+    boxes[:, 3] = np.round(center_y + (bbox_size[:, 0] / 2.0), 0) # ymax
+    boxes[:, 4] = classes
+    boxes[:, 5] = scores[keep]
+    return boxes
+
+
+def rescale_boxes(boxes, scale):
+    """
+    Map boxes detected on a page resized by scale back to page coordinates.
+    """
+    boxes = np.array(boxes, dtype=np.float32).reshape(-1, 6)
+    boxes[:, :4] = (boxes[:, :4] * (1.0 / scale)).astype(np.int32)
+    return boxes
+
+
+def fuse_scales(scale_boxes, scales, nms_thresh=0.5):
+    """
+    Merge the boxes detected at several scales of a page into page coordinates. Overlapping boxes of the same class
+    are suppressed with nms, the box with the highest score is kept.
+    """
+    boxes = np.concatenate([rescale_boxes(b, scale) for b, scale in zip(scale_boxes, scales)])
+    if len(scales) == 1 or len(boxes) == 0:
+        return boxes
+    # nms per class, boxes of different classes never suppress each other
+    dets = boxes[:, [0, 1, 2, 3, 5]].astype(np.float64)
+    keep = []
+    for cls in np.unique(boxes[:, 4]):
+        inds = np.where(boxes[:, 4] == cls)[0]
+        keep.extend(inds[nms(dets[inds], nms_thresh)])
+    return boxes[np.sort(keep)]
+
+
+def label_components(foreground, backend="scipy"):
+    """
+    Label the 8-connected components of a binary foreground mask.
+
+    Returns a dense int32 label image of the same shape as the mask, where 0 is background and the components
+    are numbered 1..nr_components, together with nr_components.
+    """
+    if backend not in CC_BACKENDS:
+        raise ValueError("unknown connected component backend: {}".format(backend))
+    labels, nr_components = CC_BACKENDS[backend](np.asarray(foreground, dtype=bool))
+    return labels.astype(np.int32, copy=False), int(nr_components)
+
+
+def _label_components_scipy(foreground):
+    return scipy.ndimage.label(foreground, structure=np.ones((3, 3), dtype=np.int32))
+
+
+def _label_components_opencv(foreground):
+    nr_labels, labels = cv2.connectedComponents(foreground.astype(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+    return labels, nr_labels - 1
+
+
+def _label_components_python(foreground):
+    # reference implementation, works with inverted indices and 255 as background
+    labels_dict, _ = find_connected_comp(np.transpose(np.where(foreground, 0, 255)))
+    return _labels_dict_to_array(labels_dict, foreground.shape)
+
+
+def _labels_dict_to_array(labels_dict, shape):
+    labels = np.zeros(shape, dtype=np.int32)
+    if len(labels_dict) == 0:
+        return labels, 0
+    coords = np.asarray(list(labels_dict.keys()))
+    # union find labels start at 0 and are not consecutive, make them 1..n
+    roots, comp_ids = np.unique(np.asarray(list(labels_dict.values())), return_inverse=True)
+    labels[coords[:, 1], coords[:, 0]] = comp_ids + 1
+    return labels, len(roots)
+
+
+CC_BACKENDS = {"scipy": _label_components_scipy,
+               "opencv": _label_components_opencv,
+               "python": _label_components_python}
+
+
+def colorize_components(labels, nr_components):
+    """
+    Produce an RGB image showing each component of a label image in a random color.
+    """
+    colors = np.zeros((nr_components + 1, 3), dtype=np.uint8)
+    for component in range(1, nr_components + 1):
+        colors[component] = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+    return Image.fromarray(colors[labels], "RGB")
+
 
 def get_class(component,class_map):
     return None
@@ -72,7 +180,7 @@ def get_bbox(component,):
 # Algorithm obtained from "Optimizing Two-Pass Connected-Component Labeling
 # by Kesheng Wu, Ekow Otoo, and Kenji Suzuki
 #
-def find_connected_comp(input):
+def find_connected_comp(input, return_img=False):
     data = input
     width, height = input.shape
 
@@ -164,12 +272,6 @@ def find_connected_comp(input):
 
     uf.flatten()
 
-    colors = {}
-
-    # Image to display the components in a nice, colorful way
-    output_img = Image.new("RGB", (width, height))
-    outdata = output_img.load()
-
     for (x, y) in labels:
 
         # Name of the component the current point belongs to
@@ -178,11 +280,8 @@ def find_connected_comp(input):
         # Update the labels with correct information
         labels[(x, y)] = component
 
-        # Associate a random color with this component
-        if component not in colors:
-            colors[component] = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+    if not return_img:
+        return (labels, None)
 
-        # Colorize the image
-        outdata[x, y] = colors[component]
-
-    return (labels, output_img)
\ No newline at end of file
+    # Image to display the components in a nice, colorful way
+    return (labels, colorize_components(*_labels_dict_to_array(labels, (height, width))))
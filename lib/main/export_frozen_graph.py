@@ -0,0 +1,69 @@
+import numpy as np
+import os
+import sys
+sys.path.insert(0,os.path.dirname(__file__)[:-4])
+from datasets.factory import get_imdb
+from dws_detector import DWSDetector, get_padded_shape, INPUT_NAME, OUTPUT_MAP_NAMES
+from inference import load_page
+from config import cfg
+import argparse
+
+
+def main(parsed):
+    parsed = parsed[0]
+    imdb = get_imdb(parsed.test_set)
+    net = DWSDetector(imdb)
+    net.export_frozen_graph(parsed.frozen_graph)
+
+    frozen_net = DWSDetector(imdb, frozen_graph=parsed.frozen_graph)
+    check_graph_names(net, frozen_net)
+    if parsed.check_images > 0:
+        check_frozen_graph(net, frozen_net, imdb, parsed)
+
+
+def check_graph_names(net, frozen_net):
+    """
+    Check that the tensors built by get_output_maps carry the names load_frozen_graph looks up, and that the frozen
+    graph returns them with the same types and shapes.
+    """
+    assert net.input.op.name == INPUT_NAME, "checkpoint input is named " + net.input.op.name
+    assert frozen_net.input.op.name == INPUT_NAME, "frozen graph input is named " + frozen_net.input.op.name
+    for name, ckpt_map, frozen_map in zip(OUTPUT_MAP_NAMES, net.output_maps, frozen_net.output_maps):
+        assert ckpt_map.op.name == name, "checkpoint output {:s} is named {:s}".format(name, ckpt_map.op.name)
+        assert frozen_map.op.name == name, "frozen graph output {:s} is named {:s}".format(name, frozen_map.op.name)
+        assert ckpt_map.dtype == frozen_map.dtype, "{:s} has type {} in the checkpoint and {} in the frozen graph".format(
+            name, ckpt_map.dtype, frozen_map.dtype)
+        assert ckpt_map.shape.ndims == frozen_map.shape.ndims, "{:s} has a different rank in the frozen graph".format(name)
+    print("Frozen graph input and output names match the checkpoint")
+
+
+def check_frozen_graph(net, frozen_net, imdb, parsed):
+    """
+    Compare the output maps of the checkpoint and the frozen detector on the first images of the test set.
+    """
+    for i in range(min(parsed.check_images, len(imdb.image_index))):
+        im = load_page(imdb.image_path_at(i), [parsed.scaling])[0]
+        canv_shape = get_padded_shape(im.shape)
+        canv = np.ones([1, canv_shape[0], canv_shape[1], 1], dtype=np.uint8) * 255
+        canv[0, 0:im.shape[0], 0:im.shape[1], 0] = im
+
+        for name, ckpt_map, frozen_map in zip(["energy", "class", "bbox"], net.predict_maps(canv),
+                                              frozen_net.predict_maps(canv)):
+            max_diff = np.max(np.abs(ckpt_map.astype(np.float64) - frozen_map.astype(np.float64)))
+            print("{:s} {:s} map: max difference {:f}".format(imdb.image_index[i], name, max_diff))
+            assert max_diff <= parsed.tolerance, "frozen graph output differs from checkpoint output"
+    print("Frozen graph matches the checkpoint")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test_set", type=str, default="DeepScores_2017_debug", help="dataset the model was trained on")
+    parser.add_argument("--frozen_graph", type=str, default=cfg.ROOT_DIR + "/trained_models/music/RefineNet-Res101/frozen_inference_graph.pb",
+                        help="file the frozen inference graph is written to")
+    parser.add_argument("--check_images", type=int, default=2, help="number of test images used to compare the frozen graph against the checkpoint, 0 disables the check")
+    parser.add_argument("--scaling", type=float, default=0.5, help="scale factor applied to images after loading")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="maximal absolute difference allowed between the output maps")
+
+    parsed = parser.parse_known_args()
+
+    main(parsed)
@@ -1,75 +1,204 @@
 import numpy as np
 import os
 import cv2
-import cPickle
 from PIL import Image
 import sys
 sys.path.insert(0,os.path.dirname(__file__)[:-4])
 from datasets.factory import get_imdb
 from dws_detector import DWSDetector
+from dws_transform import perform_dws, fuse_scales
+from detection_store import DetectionWriter, load_all_boxes
+from collections import deque
+from multiprocessing import Process, cpu_count
+from multiprocessing.pool import ThreadPool
 from config import cfg
+from utils.timer import stage_timer
 import argparse
+import time
 
 
 
 def main(parsed):
     parsed = parsed[0]
     imdb = get_imdb(parsed.test_set)
-    net = DWSDetector(imdb)
-    all_boxes = test_net(net, imdb, parsed)
+    if parsed.timing_report != "" or len(get_scales(parsed)) > 1:
+        # with several scales the cost of every scale is always reported
+        stage_timer.enable()
+    if parsed.nr_shards > 1:
+        all_boxes = test_net_sharded(imdb, parsed)
+    else:
+        net = DWSDetector(imdb, frozen_graph=parsed.frozen_graph if parsed.frozen_graph != "" else None,
+                          bucket_step=parsed.bucket_step)
+        all_boxes = test_net(net, imdb, parsed)
     #all_boxes = test_net(None, imdb, parsed)
 
 
-def test_net(net, imdb, parsed):
+def load_page(image_path, scales):
+    # decode once as grayscale and rescale to every scale
+    with stage_timer.stage("decode"):
+        im = Image.open(image_path).convert('L')
+        im = np.asanyarray(im)
+        return [cv2.resize(im, None, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR) for scale in scales]
+
+
+def post_process_page(scale_maps, scales, nms_thresh, min_score, start_time=None):
+    # dws for every scale, the boxes are fused in page coordinates
+    scale_boxes = []
+    for pred_maps, scale in zip(scale_maps, scales):
+        with stage_timer.stage("dws@{:g}".format(scale)):
+            scale_boxes.append(perform_dws(*(tuple(pred_maps) + (3, 4)), min_score=min_score))
+    boxes = fuse_scales(scale_boxes, scales, nms_thresh)
+    if stage_timer.enabled and start_time is not None:
+        # time of the page through the whole pipeline, including waiting between the stages
+        stage_timer.add("page_total", time.time() - start_time)
+    return boxes
+
+
+def get_scales(parsed):
+    if parsed.scales != "":
+        return [float(x) for x in parsed.scales.split(",")]
+    return [parsed.scaling]
+
+
+def detect_pages(net, imdb, parsed, image_inds=None):
+    """
+    Run the detector over the images of the imdb (all or only image_inds) and yield (image number, boxes) in order.
+    Every page is run at all scales of get_scales(parsed), boxes are returned in page coordinates.
+
+    Decoding, the session run and the dws post-processing are overlapped: pages are decoded by a pool of
+    parsed.decode_workers threads and post-processed by a pool of parsed.post_workers threads while the main thread
+    feeds the network. At most parsed.queue_len pages wait in front of and behind the session stage.
+
+    Stage timings are recorded per call, e.g. once per page and scale for "network@<scale>", "page_total" is
+    recorded once per page from the start of its decoding to its fused boxes.
+    """
+    if image_inds is None:
+        image_inds = range(len(imdb.image_index))
+    num_images = len(image_inds)
+    queue_len = max(parsed.queue_len, 1)
+    scales = get_scales(parsed)
+    decode_pool = ThreadPool(max(parsed.decode_workers, 1))
+    post_pool = ThreadPool(max(parsed.post_workers, 1))
+    decoding = deque()
+    post_processing = deque()
+
+    try:
+        for k in range(num_images):
+            # keep the decode stage filled
+            while len(decoding) < queue_len and k + len(decoding) < num_images:
+                decoding.append((time.time(),
+                                 decode_pool.apply_async(load_page, (imdb.image_path_at(image_inds[k + len(decoding)]),
+                                                                     scales))))
+            start_time, decoded = decoding.popleft()
+            scale_ims = decoded.get()
+
+            # session stage
+            scale_maps = []
+            for im, scale in zip(scale_ims, scales):
+                with stage_timer.stage("network@{:g}".format(scale)):
+                    if parsed.tile_size > 0:
+                        scale_maps.append(net.predict_maps_tiled(im, parsed.tile_size, parsed.tile_overlap))
+                    else:
+                        scale_maps.append(net.predict_page_maps(im))
+            post_processing.append(post_pool.apply_async(post_process_page,
+                                                         (scale_maps, scales, parsed.nms_thresh, parsed.min_score,
+                                                          start_time)))
+
+            # hand out finished pages in order once the post-processing queue is full
+            while len(post_processing) > queue_len:
+                yield image_inds[k - len(post_processing) + 1], post_processing.popleft().get()
+
+        while len(post_processing) > 0:
+            yield image_inds[num_images - len(post_processing)], post_processing.popleft().get()
+    finally:
+        decode_pool.terminate()
+        post_pool.terminate()
+
+
+def write_detections(net, imdb, parsed, det_dir, image_inds):
+    """
+    Detect the given images and stream their boxes to det_dir, images already stored there are skipped on resume.
+    """
+    # detections are streamed to disk in chunks of finished images, every chunk holds the image names, the position
+    # of every box's image in them and the boxes as (x1, y1, x2, y2, class, score) rows, see DetectionWriter
+    det_writer = DetectionWriter(det_dir, chunk_size=parsed.chunk_size, resume=parsed.resume == "True")
+    todo_inds = [i for i in image_inds if imdb.image_index[i] not in det_writer.processed_images]
+    if len(todo_inds) < len(image_inds):
+        print('Resuming, {:d} images already processed'.format(len(image_inds) - len(todo_inds)))
+
+    for i, boxes in detect_pages(net, imdb, parsed, todo_inds):
+        if i%500 == 0:
+            print(i)
+
+        # boxes = np.array([[938, 94, 943, 99, 37], [994, 74, 1006, 85, 29], [994, 74, 1006, 85, 29], [994, 211, 1011, 223, 31]])
+        # show_image([np.asanyarray(im)], boxes, True, True)
+
+        det_writer.add(imdb.image_index[i], boxes)
+    det_writer.close()
+
+
+def test_net_sharded(imdb, parsed):
+    """
+    Split the images of the imdb over parsed.nr_shards processes, each with its own detector and a budget of
+    parsed.shard_threads TensorFlow threads, then merge their detections and evaluate.
+    """
     output_dir = cfg.OUT_DIR
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    # all_boxes[cls][image] = N x 5 array of detections in
-    # (x1, y1, x2, y2, class)
-    all_boxes = [[[] for _ in range(num_images)]
-                 for _ in range(imdb.num_classes)]
+    det_dir = os.path.join(output_dir, 'detections_' + imdb.name)
+    shard_dirs = [os.path.join(det_dir, 'shard_{:d}'.format(k)) for k in range(parsed.nr_shards)]
 
-    #output_dir = get_output_dir(imdb, output_dir)
+    shards = [Process(target=run_shard, args=(imdb, parsed, k, shard_dirs[k])) for k in range(parsed.nr_shards)]
+    [shard.start() for shard in shards]
+    [shard.join() for shard in shards]
+    failed = [k for k, shard in enumerate(shards) if shard.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError('shards {} failed, rerun with --resume True'.format(failed))
 
-    # timers
-    det_file = os.path.join(output_dir, 'detections.pkl')
+    if stage_timer.enabled:
+        # the shards record their timings in their own processes
+        for shard_dir in shard_dirs:
+            stage_timer.merge(os.path.join(shard_dir, 'stage_timings.json'))
+        report_timings(parsed)
 
+    all_boxes = load_all_boxes(shard_dirs, imdb)
 
-    print(num_images)
-    for i in range(num_images):
-        if i%500 == 0:
-            print i
+    print('Evaluating detections')
+    imdb.evaluate_detections(all_boxes, output_dir)
+    return all_boxes
 
-        im = Image.open(imdb.image_path_at(i)).convert('L')
-        im = np.asanyarray(im)
-        im = cv2.resize(im, None, None, fx=parsed.scaling, fy=parsed.scaling, interpolation=cv2.INTER_LINEAR)
-        # if im.shape[0]*im.shape[1]>3837*2713:
-        #     print(im.shape)
-        #     print(imdb.image_path_at(i).split("/")[-1][:-4])
-        #     list_large.append(imdb.image_path_at(i).split("/")[-1][:-4])
 
-        boxes = net.classify_img(im,3,4)
-        # boxes = np.array([[938, 94, 943, 99, 37], [994, 74, 1006, 85, 29], [994, 74, 1006, 85, 29], [994, 211, 1011, 223, 31]])
-        # show_image([np.asanyarray(im)], boxes, True, True)
-        no_objects = len(boxes)
-        for j in range(len(boxes)):
-            # invert scaling for Boxes
-            boxes[j] = np.array(boxes[j])
-            boxes[j][:-1] = (boxes[j][:-1]*(1/parsed.scaling)).astype(np.int)
+def run_shard(imdb, parsed, shard, shard_dir):
+    # every shard takes every nr_shards-th image, so that all shards see a similar mix of page sizes
+    nr_threads = parsed.shard_threads if parsed.shard_threads > 0 else max(cpu_count() // parsed.nr_shards, 1)
+    net = DWSDetector(imdb, frozen_graph=parsed.frozen_graph if parsed.frozen_graph != "" else None,
+                      nr_threads=nr_threads, bucket_step=parsed.bucket_step)
+    write_detections(net, imdb, parsed, shard_dir, range(shard, len(imdb.image_index), parsed.nr_shards))
+    if stage_timer.enabled:
+        stage_timer.dump(os.path.join(shard_dir, 'stage_timings.json'))
+
 
-            class_of_symbol = boxes[j][4]
-            all_boxes[class_of_symbol][i].append(np.array(boxes[j]))
+def report_timings(parsed):
+    print('Stage timings per call, page_total per page:')
+    stage_timer.print_summary()
+    if parsed.timing_report != "":
+        stage_timer.write_report(parsed.timing_report)
 
 
+def test_net(net, imdb, parsed):
+    output_dir = cfg.OUT_DIR
+    num_images = len(imdb.image_index)
 
-    # convert to np array
-    for i1 in range(len(all_boxes)):
-        for i2 in range(len(all_boxes[i1])):
-            all_boxes[i1][i2] = np.asarray(all_boxes[i1][i2])
+    #output_dir = get_output_dir(imdb, output_dir)
 
-    # inspect all_boxes variable
-    with open(det_file, 'wb') as f:
-         cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+    det_dir = os.path.join(output_dir, 'detections_' + imdb.name)
+    print(num_images)
+    write_detections(net, imdb, parsed, det_dir, range(num_images))
+    if stage_timer.enabled:
+        report_timings(parsed)
+
+    # all detections are collected into:
+    # all_boxes[cls][image] = N x 6 array of detections in
+    # (x1, y1, x2, y2, class, score)
+    all_boxes = load_all_boxes(det_dir, imdb)
 
 
 
@@ -93,8 +222,23 @@ def test_net(net, imdb, parsed):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--scaling", type=int, default=0.5, help="scale factor applied to images after loading")
+    parser.add_argument("--scaling", type=float, default=0.5, help="scale factor applied to images after loading")
+    parser.add_argument("--scales", type=str, default="", help="comma separated scale factors to detect at, overrides --scaling")
+    parser.add_argument("--min_score", type=float, default=0, help="drop detections with a lower score (mean energy times class purity)")
+    parser.add_argument("--nms_thresh", type=float, default=0.5, help="overlap above which boxes of the same class found at different scales are merged")
     parser.add_argument("--test_set", type=str, default="DeepScores_2017_debug", help="dataset to perform inference on")
+    parser.add_argument("--bucket_step", type=int, default=160, help="pages are padded to multiples of this (a multiple of 160), larger steps like 320 let fewer distinct input shapes reach the network but widen the white margin, detections near the right and bottom page edges can change slightly")
+    parser.add_argument("--frozen_graph", type=str, default="", help="load the detector from a graph written by export_frozen_graph.py instead of the checkpoint")
+    parser.add_argument("--tile_size", type=int, default=0, help="run the network on tiles of this size (multiple of 160), 0 feeds the whole page")
+    parser.add_argument("--tile_overlap", type=int, default=320, help="overlap between neighbouring tiles")
+    parser.add_argument("--chunk_size", type=int, default=100, help="number of images per detection file written to disk")
+    parser.add_argument("--resume", type=str, default="False", help="skip images whose detections are already on disk")
+    parser.add_argument("--decode_workers", type=int, default=2, help="threads decoding and rescaling images")
+    parser.add_argument("--post_workers", type=int, default=2, help="threads running the dws post-processing")
+    parser.add_argument("--nr_shards", type=int, default=1, help="number of processes the test set is split over")
+    parser.add_argument("--shard_threads", type=int, default=0, help="TensorFlow threads per shard, 0 divides the cores evenly")
+    parser.add_argument("--timing_report", type=str, default="", help="record per call stage timings and per page totals and write them as json to this file")
+    parser.add_argument("--queue_len", type=int, default=4, help="pages buffered before and after the network")
 
     # configure output heads used ---> have to match trained model
 
@@ -164,13 +164,8 @@ def get_checkpoint_dir(args):
     return tbdir
 
 
-def get_training_roidb(imdb, use_flipped):
+def get_training_roidb(imdb):
   """Returns a roidb (Region of Interest database) for use in training."""
-  if use_flipped:
-    print('Appending horizontally-flipped training examples...')
-    imdb.append_flipped_images()
-    print('done')
-
   print('Preparing training data...')
   rdl_roidb.prepare_roidb(imdb)
   print('done')
@@ -193,21 +188,21 @@ def load_database(args):
     print("Setting up image database: " + args.dataset)
     imdb = get_imdb(args.dataset)
     print('Loaded dataset `{:s}` for training'.format(imdb.name))
-    roidb = get_training_roidb(imdb, args.use_flipped == "True")
+    roidb = get_training_roidb(imdb)
     print('{:d} roidb entries'.format(len(roidb)))
 
     if args.dataset_validation != "no":
         print("Setting up validation image database: " + args.dataset_validation)
         imdb_val = get_imdb(args.dataset_validation)
         print('Loaded dataset `{:s}` for validation'.format(imdb_val.name))
-        roidb_val = get_training_roidb(imdb_val, False)
+        roidb_val = get_training_roidb(imdb_val)
         print('{:d} roidb entries'.format(len(roidb_val)))
     else:
         imdb_val = None
         roidb_val = None
 
 
-    data_layer = RoIDataLayer(roidb, imdb.num_classes)
+    data_layer = RoIDataLayer(roidb, imdb.num_classes, use_flipped=args.use_flipped == "True")
 
     if roidb_val is not None:
         data_layer_val = RoIDataLayer(roidb_val, imdb_val.num_classes, random=True)
@@ -225,7 +220,7 @@ if __name__ == '__main__':
   parser.add_argument("--max_edge", type=int, default=800,
                       help="if there is no cropping - scale such that the longest edge has this size / if there is cropping crop to max_edge * max_edge")
   parser.add_argument("--use_flipped", type=str, default="False",
-                      help="wether or not to append Horizontally flipped images")
+                      help="wether or not to randomly flip images horizontally during training")
   parser.add_argument("--substract_mean", type=str, default="False",
                       help="wether or not to substract the mean of the VOC images")
   parser.add_argument("--pad_to", type=int, default=160,
@@ -11,7 +11,7 @@ from models.dwd_net import build_dwd_net
 from datasets.factory import get_imdb
 from tensorflow.contrib import slim
 from utils.safe_softmax_wrapper import safe_softmax_cross_entropy_with_logits
-import roi_data_layer.roidb as rdl_roidb
+from roi_data_layer.columnar_roidb import ColumnarRoidb, build_columnar_roidb
 from roi_data_layer.layer import RoIDataLayer
 from utils.prefetch_wrapper import PrefetchWrapper
 
@@ -674,18 +674,18 @@ def get_checkpoint_dir(args):
     return tbdir
 
 
-def get_training_roidb(imdb, use_flipped):
+def get_training_roidb(imdb):
   """Returns a roidb (Region of Interest database) for use in training."""
-  if use_flipped:
-    print('Appending horizontally-flipped training examples...')
-    imdb.append_flipped_images()
-    print('done')
-
   print('Preparing training data...')
-  rdl_roidb.prepare_roidb(imdb)
+  # boxes and classes of all images in a few flat arrays instead of one dict per image
+  roidb_dir = os.path.join(imdb.cache_path, imdb.name + '_roidb')
+  build_columnar_roidb(imdb).save(roidb_dir)
+  # drop the per image dicts, the prefetch workers share the read-only memory-mapped columns
+  imdb._roidb = None
+  roidb = ColumnarRoidb.load(roidb_dir, mmap_mode='r')
   print('done')
 
-  return imdb.roidb
+  return roidb
 
 
 def save_objectness_function_handles(args, imdb):
@@ -704,21 +704,22 @@ def load_database(args):
     print("Setting up image database: " + args.dataset)
     imdb = get_imdb(args.dataset)
     print('Loaded dataset `{:s}` for training'.format(imdb.name))
-    roidb = get_training_roidb(imdb, args.use_flipped == "True")
+    roidb = get_training_roidb(imdb)
     print('{:d} roidb entries'.format(len(roidb)))
 
     if args.dataset_validation != "no":
         print("Setting up validation image database: " + args.dataset_validation)
         imdb_val = get_imdb(args.dataset_validation)
         print('Loaded dataset `{:s}` for validation'.format(imdb_val.name))
-        roidb_val = get_training_roidb(imdb_val, False)
+        roidb_val = get_training_roidb(imdb_val)
         print('{:d} roidb entries'.format(len(roidb_val)))
     else:
         imdb_val = None
         roidb_val = None
 
 
-    data_layer = RoIDataLayer(roidb, imdb.num_classes)
+    # horizontal flips are sampled with the minibatches instead of appended to the roidb
+    data_layer = RoIDataLayer(roidb, imdb.num_classes, use_flipped=args.use_flipped == "True")
 
     if roidb_val is not None:
         data_layer_val = RoIDataLayer(roidb_val, imdb_val.num_classes, random=True)
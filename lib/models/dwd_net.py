@@ -4,33 +4,53 @@ from tensorflow.contrib import slim
 from main.config import cfg
 
 
-def build_dwd_net(input,model,num_classes,pretrained_dir,substract_mean = False):
+def build_dwd_net(input,model,num_classes,pretrained_dir,substract_mean = False, heads=None, levels=None):
+    """
+    Build RefineNet with the deep watershed output heads on top.
+
+    heads: optional dict head -> list of losses (e.g. {"stamp_energy": ["softmax"]}) restricting which heads are built,
+        by default every head is built
+    levels: optional list of RefineNet levels the heads are built at (negative indices allowed), by default all levels
+
+    network_heads[head][loss] is a list over all levels, levels that are not built are None. The variable names are
+    the same as in the full network, so a pruned network restores from a full training checkpoint.
+    """
     g, init_fn = build_refinenet(input, preset_model=model, num_classes=None, pretrained_dir=pretrained_dir,
                                  substract_mean=substract_mean)
 
+    if levels is None:
+        levels = range(0, len(g))
+    levels = [x % len(g) for x in levels]
+
+    def build_head(head, loss, nr_outputs, scope):
+        if heads is not None and loss not in heads.get(head, []):
+            return
+        network_heads[head][loss] = [slim.conv2d(g[x], nr_outputs, [1, 1], activation_fn=None, scope=scope + str(x))
+                                     if x in levels else None for x in range(0, len(g))]
+
     network_heads = dict()
     with tf.variable_scope('deep_watershed'):
 
         network_heads["stamp_class"] = dict()
         # class binary
-        network_heads["stamp_class"]["binary"] = [slim.conv2d(g[x], 2, [1, 1], activation_fn=None, scope='class_binary_'+str(x)) for x in range(0, len(g))]
+        build_head("stamp_class", "binary", 2, 'class_binary_')
         # class pred
-        network_heads["stamp_class"]["softmax"] = [slim.conv2d(g[x], num_classes, [1, 1], activation_fn=None, scope='class_pred_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_class", "softmax", num_classes, 'class_pred_')
 
         # direction
         network_heads["stamp_directions"] = dict()
-        network_heads["stamp_directions"]["reg"] = [slim.conv2d(g[x], 2, [1, 1], activation_fn=None, scope='direction_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_directions", "reg", 2, 'direction_')
 
         network_heads["stamp_energy"] = dict()
         # energy marker - regression
-        network_heads["stamp_energy"]["reg"] = [slim.conv2d(g[x], 1, [1, 1], activation_fn=None, scope='energy_reg_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_energy", "reg", 1, 'energy_reg_')
         # energy marker - logits
-        network_heads["stamp_energy"]["softmax"] = [slim.conv2d(g[x], cfg.TRAIN.MAX_ENERGY, [1, 1], activation_fn=None, scope='energy_logits_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_energy", "softmax", cfg.TRAIN.MAX_ENERGY, 'energy_logits_')
 
         network_heads["stamp_bbox"] = dict()
         # bbox_size - reg
-        network_heads["stamp_bbox"]["reg"] = [slim.conv2d(g[x], 2, [1, 1], activation_fn=None, scope='bbox_reg_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_bbox", "reg", 2, 'bbox_reg_')
         # bbox_size - logits
-        network_heads["stamp_bbox"]["softmax"] = [slim.conv2d(g[x], 2, [1, 1], activation_fn=None, scope='bbox_logits_' + str(x)) for x in range(0, len(g))]
+        build_head("stamp_bbox", "softmax", 2, 'bbox_logits_')
 
-        return network_heads, init_fn
\ No newline at end of file
+        return network_heads, init_fn
@@ -0,0 +1,148 @@
+# --------------------------------------------------------
+# Columnar roidb
+# --------------------------------------------------------
+
+"""A roidb stored as a few flat arrays instead of one dict per image.
+
+Per image columns hold the image path, size and flip flag, per box columns
+hold the boxes and classes of all images concatenated, box_offsets[i] to
+box_offsets[i + 1] are the boxes of image i. Every column is saved as its own
+.npy file, so a saved roidb can be opened memory-mapped: processes forked
+from the one that opened it, e.g. the PrefetchWrapper workers, share one copy
+of the columns through the page cache instead of copying pages that reference
+counting of per image python objects would touch.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+import scipy.sparse
+
+IMAGE_COLUMNS = ['image', 'width', 'height', 'flipped']
+BOX_COLUMNS = ['boxes', 'gt_classes', 'max_classes', 'max_overlaps', 'seg_areas']
+
+
+class ColumnarRoidb(object):
+  """Columns of a roidb. Indexing returns a RoidbEntry, which answers the
+  keys of a prepared roidb dict ('image', 'boxes', 'gt_classes', ...) with
+  slices of the columns, so RoIDataLayer and get_minibatch work unchanged.
+  """
+
+  def __init__(self, columns, num_classes, roidb_dir=None):
+    self.columns = columns
+    self.num_classes = num_classes
+    # set if the columns are memory-mapped from this directory
+    self.roidb_dir = roidb_dir
+
+  def __getstate__(self):
+    # a memory-mapped roidb is sent to other processes as its directory only
+    if self.roidb_dir is not None:
+      return {'roidb_dir': self.roidb_dir}
+    return self.__dict__
+
+  def __setstate__(self, state):
+    if 'columns' in state:
+      self.__dict__.update(state)
+    else:
+      self.__dict__.update(ColumnarRoidb.load(state['roidb_dir']).__dict__)
+
+  def __len__(self):
+    return len(self.columns['width'])
+
+  def __getitem__(self, i):
+    return RoidbEntry(self, int(i))
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield RoidbEntry(self, i)
+
+  def get(self, i, key):
+    if key == 'image':
+      return str(self.columns['image'][i])
+    if key in IMAGE_COLUMNS:
+      return self.columns[key][i]
+    start, end = self.columns['box_offsets'][i:i + 2]
+    if key == 'gt_overlaps':
+      # gt boxes overlap only with their own class
+      max_classes = self.columns['max_classes'][start:end]
+      return scipy.sparse.csr_matrix(
+        (self.columns['max_overlaps'][start:end],
+         (np.arange(end - start), max_classes)),
+        shape=(end - start, self.num_classes))
+    return self.columns[key][start:end]
+
+  def save(self, roidb_dir):
+    """Write every column to roidb_dir. Files are replaced by renaming, so
+    processes that still have the old files mapped keep reading them."""
+    if not os.path.exists(roidb_dir):
+      os.makedirs(roidb_dir)
+    columns = dict(self.columns)
+    columns['num_classes'] = np.array(self.num_classes)
+    for name, column in columns.items():
+      filename = os.path.join(roidb_dir, name + '.npy')
+      with open(filename + '.tmp', 'wb') as f:
+        np.save(f, column)
+      os.rename(filename + '.tmp', filename)
+
+  @classmethod
+  def load(cls, roidb_dir, mmap_mode='r'):
+    """Open a saved roidb, by default read-only memory-mapped."""
+    columns = dict((name, np.load(os.path.join(roidb_dir, name + '.npy'),
+                                  mmap_mode=mmap_mode))
+                   for name in IMAGE_COLUMNS + BOX_COLUMNS + ['box_offsets'])
+    num_classes = int(np.load(os.path.join(roidb_dir, 'num_classes.npy')))
+    return cls(columns, num_classes, roidb_dir if mmap_mode is not None else None)
+
+
+class RoidbEntry(object):
+  """One image of a ColumnarRoidb, indexed like a roidb dict."""
+  __slots__ = ('_roidb', '_index')
+
+  def __init__(self, roidb, index):
+    self._roidb = roidb
+    self._index = index
+
+  def __getitem__(self, key):
+    return self._roidb.get(self._index, key)
+
+
+def build_columnar_roidb(imdb):
+  """Columnar counterpart of prepare_roidb: collects the gt roidb of the imdb
+  together with image paths, sizes and the max overlap class of every box.
+
+  Datasets with a gt_columns method return the box columns of their gt roidb
+  straight from the parsed annotations, so the per image dict roidb is never
+  built. For other datasets or proposal methods the columns are collected
+  from imdb.roidb.
+  """
+  gt_columns = getattr(imdb, 'gt_columns', None)
+  if gt_columns is not None and imdb.roidb_handler == imdb.gt_roidb:
+    columns = gt_columns()
+  else:
+    columns = roidb_columns(imdb.roidb)
+
+  sizes = np.array(imdb.image_sizes(), dtype=np.int32).reshape(-1, 2)
+  columns['image'] = np.array([imdb.image_path_at(i)
+                               for i in range(imdb.num_images)])
+  columns['width'] = sizes[:, 0]
+  columns['height'] = sizes[:, 1]
+  return ColumnarRoidb(columns, imdb.num_classes)
+
+
+def roidb_columns(roidb):
+  """Box columns and flip flags of a list of roidb dicts. The overlaps of all
+  images are reduced in one sparse matrix, no dense objects x classes array
+  is built.
+  """
+  nr_boxes = np.array([len(r['gt_classes']) for r in roidb], dtype=np.int64)
+  overlaps = scipy.sparse.vstack([r['gt_overlaps'] for r in roidb]).tocsr()
+  return {
+    'flipped': np.array([r['flipped'] for r in roidb], dtype=bool),
+    'box_offsets': np.concatenate([[0], np.cumsum(nr_boxes)]),
+    'boxes': np.concatenate([r['boxes'].reshape(-1, 4) for r in roidb]),
+    'gt_classes': np.concatenate([r['gt_classes'] for r in roidb]),
+    'max_classes': np.asarray(overlaps.argmax(axis=1)).ravel(),
+    'max_overlaps': overlaps.max(axis=1).toarray().ravel(),
+    'seg_areas': np.concatenate([r['seg_areas'] for r in roidb])}
@@ -21,12 +21,14 @@ import time
 class RoIDataLayer(object):
   """Fast R-CNN data layer used for training."""
 
-  def __init__(self, roidb, num_classes, random=False):
+  def __init__(self, roidb, num_classes, random=False, use_flipped=False):
     """Set the roidb to be used by this layer during training."""
     self._roidb = roidb
     self._num_classes = num_classes
     # Also set a random flag
     self._random = random
+    # flip every sampled image horizontally with probability 0.5
+    self._use_flipped = use_flipped
     self._shuffle_roidb_inds()
 
   def _shuffle_roidb_inds(self):
@@ -87,7 +89,7 @@ class RoIDataLayer(object):
     if lock is not None:
       lock.release()
     minibatch_db = [self._roidb[i] for i in db_inds]
-    return get_minibatch(minibatch_db, args, assign, helper)
+    return get_minibatch(minibatch_db, args, assign, helper, self._use_flipped)
       
   def forward(self, args, assign, helper=None,lock=None):
     """Get blobs and copy them into this layer's top blob vector."""
@@ -18,18 +18,25 @@ from utils.blob import prep_im_for_blob, im_list_to_blob
 from datasets.fcn_groundtruth import get_markers,stamp_class
 
 
-def get_minibatch(roidb, args, assign, helper):
-    """Given a roidb, construct a minibatch sampled from it."""
+def get_minibatch(roidb, args, assign, helper, use_flipped=False):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    If use_flipped is set, every image is flipped horizontally with
+    probability 0.5, together with its boxes.
+    """
     num_images = len(roidb)
     # Sample random scales to use for each image in this batch
     random_scale_inds = npr.randint(0, high=len(args.scale_list),
                                     size=num_images)
+    flipped = np.array([r['flipped'] for r in roidb], dtype=bool)
+    if use_flipped:
+        flipped ^= npr.rand(num_images) < 0.5
     assert (args.batch_size % num_images == 0), \
         'num_images ({}) must divide BATCH_SIZE ({})'. \
             format(num_images, args.batch_size)
 
     # Get the input image blob
-    im_blob, im_scales, crop_box = _get_image_blob(roidb, random_scale_inds, args)
+    im_blob, im_scales, crop_box = _get_image_blob(roidb, random_scale_inds, flipped, args)
 
     blobs = {'data': im_blob}
 
@@ -46,9 +53,13 @@ def get_minibatch(roidb, args, assign, helper):
 
     gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
 
+    boxes = roidb[0]['boxes'][gt_inds, :]
+    if flipped[0]:
+        boxes = flip_boxes(boxes, roidb[0]['width'])
+
     if args.crop == "True":
         # scale Coords
-        gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
+        gt_boxes[:, 0:4] = boxes * im_scales[0]
 
         gt_boxes[:, 0:4] = gt_boxes[:, 0:4] - [crop_box[0][1], crop_box[0][0], crop_box[0][1], crop_box[0][0]]
 
@@ -56,7 +67,7 @@ def get_minibatch(roidb, args, assign, helper):
         # bad_coords = np.sum(gt_boxes[:, 0:4][:, [0, 1]] >= 0, 1) + np.sum(gt_boxes[:, 0:4][:, [2, 3]] < cfg.TRAIN.MAX_SIZE, 1) < 4
 
     else:
-        gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
+        gt_boxes[:, 0:4] = boxes * im_scales[0]
 
     gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
 
@@ -147,6 +158,18 @@ def get_minibatch(roidb, args, assign, helper):
     return blobs
 
 
+def flip_boxes(boxes, width):
+    """Mirror (x1, y1, x2, y2) boxes of an image of the given width horizontally.
+    The roidb boxes are uint16, they are flipped as int32 so that boxes ending
+    at the right border do not wrap around, and clipped to the image."""
+    boxes = boxes.astype(np.int32)
+    flipped = boxes.copy()
+    flipped[:, 0] = width - boxes[:, 2] - 1
+    flipped[:, 2] = width - boxes[:, 0] - 1
+    flipped[:, [0, 2]] = np.clip(flipped[:, [0, 2]], 0, width - 1)
+    return flipped
+
+
 def crop_boxes(img_shape, coord):
     crop_coords = coord[0:4]
     crop_coords = np.maximum(crop_coords, 0)
@@ -161,9 +184,9 @@ def crop_boxes(img_shape, coord):
     return coord
 
 
-def _get_image_blob(roidb, scale_inds, args):
+def _get_image_blob(roidb, scale_inds, flipped, args):
     """Builds an input blob from the images in the roidb at the specified
-    scales.
+    scales, images whose flipped entry is set are mirrored horizontally.
     """
     num_images = len(roidb)
     processed_ims = []
@@ -172,7 +195,7 @@ def _get_image_blob(roidb, scale_inds, args):
 
     for i in range(num_images):
         im = cv2.imread(roidb[i]['image'])
-        if roidb[i]['flipped']:
+        if flipped[i]:
             im = im[:, ::-1, :]
         global_scale = args.scale_list[scale_inds[i]]
         im, im_scale, im_crop_box = prep_im_for_blob(im, cfg.PIXEL_MEANS, global_scale, args)
@@ -14,7 +14,6 @@ import numpy as np
 from main.config import cfg
 from main.bbox_transform import bbox_transform
 from utils.bbox import bbox_overlaps
-import PIL
 
 def prepare_roidb(imdb):
   """Enrich the imdb's roidb by adding some derived quantities that
@@ -25,8 +24,7 @@ def prepare_roidb(imdb):
   """
   roidb = imdb.roidb
   if not (imdb.name.startswith('coco')):
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-         for i in range(imdb.num_images)]
+    sizes = imdb.image_sizes()
   for i in range(len(imdb.image_index)):
     roidb[i]['image'] = imdb.image_path_at(i)
     if not (imdb.name.startswith('coco')):
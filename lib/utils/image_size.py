@@ -0,0 +1,28 @@
+"""Image size lookup that reads file headers instead of decoding pixels."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+import PIL.Image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def get_image_size(path):
+  """Return (width, height) of an image, like PIL's Image.size.
+
+  For PNG files width and height are read from the IHDR chunk that directly
+  follows the signature, other formats fall back to PIL, which also only
+  parses the header on open.
+  """
+  with open(path, 'rb') as f:
+    header = f.read(24)
+  if len(header) == 24 and header[:8] == PNG_SIGNATURE \
+      and header[12:16] == b'IHDR':
+    return struct.unpack('>II', header[16:24])
+  im = PIL.Image.open(path)
+  try:
+    return im.size
+  finally:
+    im.close()
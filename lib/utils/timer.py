@@ -6,6 +6,10 @@
 # --------------------------------------------------------
 
 import time
+import json
+import threading
+import collections
+import numpy as np
 
 class Timer(object):
     """A simple timer."""
@@ -30,3 +34,116 @@ class Timer(object):
             return self.average_time
         else:
             return self.diff
+
+
+class StageTimer(object):
+    """Records the duration of every pass through named stages, e.g. once per
+    image, and summarizes them as percentiles. A disabled StageTimer hands
+    out a shared no-op context and records nothing.
+
+    With a window only the last window durations of every stage are kept for
+    the percentiles, calls and total still count every pass, so a long running
+    process does not grow without bound."""
+    def __init__(self, enabled=False, window=None):
+        self.enabled = enabled
+        self.window = window
+        self.durations = {}
+        self.calls = {}
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self.durations = {}
+            self.calls = {}
+            self.totals = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, duration):
+        with self._lock:
+            self._add_stage(name)
+            self.durations[name].append(duration)
+            self.calls[name] += 1
+            self.totals[name] += duration
+
+    def _add_stage(self, name):
+        if name not in self.durations:
+            self.durations[name] = collections.deque(maxlen=self.window)
+            self.calls[name] = 0
+            self.totals[name] = 0.
+
+    def dump(self, filename):
+        """Write the recorded durations as json, to be merged into the timer
+        of another process."""
+        with self._lock:
+            state = {'durations': dict((name, list(durations)) for name, durations in self.durations.items()),
+                     'calls': dict(self.calls), 'totals': dict(self.totals)}
+        with open(filename, 'w') as f:
+            json.dump(state, f)
+
+    def merge(self, filename):
+        """Add the durations written by dump."""
+        with open(filename, 'r') as f:
+            state = json.load(f)
+        with self._lock:
+            for name, durations in state['durations'].items():
+                self._add_stage(name)
+                self.durations[name].extend(durations)
+                self.calls[name] += state['calls'][name]
+                self.totals[name] += state['totals'][name]
+
+    def summary(self):
+        """Per stage: number of calls, total, mean and p50/p95/p99 in seconds.
+        Mean and percentiles are taken over the window."""
+        with self._lock:
+            stages = [(name, np.array(durations), self.calls[name], self.totals[name])
+                      for name, durations in self.durations.items()]
+        summary = {}
+        for name, durations, calls, total in stages:
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            summary[name] = {'calls': calls, 'total': float(total),
+                             'mean': float(durations.mean()), 'p50': float(p50), 'p95': float(p95),
+                             'p99': float(p99)}
+        return summary
+
+    def write_report(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def print_summary(self):
+        for name, s in sorted(self.summary().items()):
+            print('{:<24s} calls {:6d}  mean {:8.4f}s  p50 {:8.4f}s  p95 {:8.4f}s  p99 {:8.4f}s'.format(
+                name, s['calls'], s['mean'], s['p50'], s['p95'], s['p99']))
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.time()
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.time() - self.start_time)
+
+
+class _NoStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+# shared by the detection path, enabled on request
+stage_timer = StageTimer()